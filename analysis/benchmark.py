@@ -0,0 +1,311 @@
+# Benchmark of the pipeline on synthetic populations
+#
+# For each population size, generates synthetic source tables
+# (synthetic_population.py) and runs the actions of project.yaml on them,
+# recording the wall-clock time and peak memory of each stage:
+# - import_<study>: importing each extracted study definition, as every
+#   extraction and measures action does on start-up
+# - the generate_cohort actions, with extract_monthly.py extracting from the
+#   synthetic source in place of cohortextractor. A study without an index
+#   date range (the ethnicity cohort) is extracted at its own index date.
+# - extract_shared: the monthly cohorts of every study extracted together by a
+#   single run of extract_monthly.py, which evaluates the variables the
+#   studies share once
+# - join_ethnicity: a left join of the ethnicity cohort onto each monthly
+#   cohort, in place of cohort-joiner
+# - every other cohortextractor and python action (measures, join_measures,
+#   deciles, report figures, ...), with its command line from project.yaml
+#
+# Actions of other images (e.g. deciles-charts) are skipped. Each population
+# size has a workspace of its own, with links to the analysis and codelists
+# directories of the repository, so every action reads and writes the same
+# relative paths as in project.yaml.
+#
+# Each stage runs in its own process, so its peak memory (maximum resident
+# set size) is measured on its own. Results are written to benchmark.csv in
+# the output directory. With --baseline, stages that are slower or use more
+# memory than in an earlier benchmark.csv (beyond --tolerance) are reported
+# and the script exits with an error.
+#
+# Usage:
+# python analysis/benchmark.py \
+#   --sizes 10000 1000000 10000000 \
+#   --output-dir output/benchmark
+
+import argparse
+import glob
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+import pandas as pd
+import yaml
+
+from date_utils import generate_date_range
+from extract_monthly import extract_monthly, load_source, load_study
+from feather_io import read_feather
+from generate_measures import study_suffix
+
+ANALYSIS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(ANALYSIS_DIR)
+PROJECT_FILE = os.path.join(REPO_DIR, "project.yaml")
+
+# Directories of the repository that the actions read
+WORKSPACE_LINKS = ["analysis", "codelists"]
+
+
+def script(name):
+    return [sys.executable, os.path.join(ANALYSIS_DIR, name)]
+
+
+def inline_stage(name, *arguments):
+    return script("benchmark.py") + ["--run-stage", name, *arguments]
+
+
+def import_command(study_name):
+    # Cold start of a new interpreter importing a study definition
+    return [
+        sys.executable,
+        "-c",
+        f"import sys; sys.path.insert(0, {ANALYSIS_DIR!r}); import {study_name}",
+    ]
+
+
+def project_actions():
+    # (name, image, arguments) of each action of project.yaml, in order
+    with open(PROJECT_FILE) as f:
+        actions = yaml.safe_load(f)["actions"]
+    for name, action in actions.items():
+        image, *arguments = shlex.split(action["run"])
+        yield name, image.split(":")[0], arguments
+
+
+def option_values(arguments):
+    # Values of each option of a command line, e.g. ["--lhs", "a", "b",
+    # "--output-dir=c"] gives {"lhs": ["a", "b"], "output-dir": ["c"]}
+    values = {}
+    option = None
+    for argument in arguments:
+        if argument.startswith("--"):
+            option, _, value = argument[2:].partition("=")
+            values[option] = [value] if value else []
+        elif option is not None:
+            values[option].append(argument)
+    return values
+
+
+def cohort_extraction(image, arguments, index_date_range=None):
+    # (study name, index date range or None) of a generate_cohort action, or
+    # None for any other action
+    if image != "cohortextractor" or arguments[0] != "generate_cohort":
+        return None
+    values = option_values(arguments)
+    date_range = values.get("index-date-range")
+    if date_range is not None:
+        date_range = index_date_range or date_range[0]
+    return values["study-definition"][0], date_range
+
+
+def pipeline_stages(size, index_date_range=None):
+    # (name, command) of each stage, in order. Paths are relative to the
+    # workspace. With index_date_range, the monthly cohorts are extracted for
+    # that range instead of the one in project.yaml.
+    source_dir = "source"
+    actions = list(project_actions())
+    extractions = {
+        name: extraction
+        for name, image, arguments in actions
+        if (extraction := cohort_extraction(image, arguments, index_date_range))
+    }
+    stages = [
+        (f"import_{study_name}", import_command(study_name))
+        for study_name, _ in extractions.values()
+    ]
+    stages.append(
+        (
+            "synthetic_population",
+            script("synthetic_population.py")
+            + ["--size", str(size), "--output-dir", source_dir],
+        )
+    )
+    monthly = [(name, dates) for name, dates in extractions.values() if dates]
+    for name, image, arguments in actions:
+        values = option_values(arguments)
+        if name in extractions:
+            study_name, date_range = extractions[name]
+            stages.append(
+                (
+                    name,
+                    inline_stage(
+                        "generate_cohort",
+                        source_dir,
+                        values["output-dir"][0],
+                        study_name,
+                        *([date_range] if date_range else []),
+                    ),
+                )
+            )
+            if name == list(extractions)[-1]:
+                stages.append(
+                    (
+                        "extract_shared",
+                        script("extract_monthly.py")
+                        + ["--study-definition", *(name for name, _ in monthly)]
+                        + ["--index-date-range", monthly[0][1]]
+                        + ["--source-dir", source_dir]
+                        + ["--output-dir", "output/shared"],
+                    )
+                )
+        elif image == "cohortextractor":
+            stages.append((name, ["cohortextractor", *arguments]))
+        elif image == "cohort-joiner":
+            stages.append(
+                (
+                    name,
+                    inline_stage(
+                        "join_cohorts",
+                        values["lhs"][0],
+                        values["rhs"][0],
+                        values["output-dir"][0],
+                    ),
+                )
+            )
+        elif image == "python":
+            stages.append((name, [sys.executable, *arguments]))
+    return stages
+
+
+def make_workspace(work_dir):
+    os.makedirs(os.path.join(work_dir, "logs"), exist_ok=True)
+    for name in WORKSPACE_LINKS:
+        link = os.path.join(work_dir, name)
+        if not os.path.islink(link):
+            os.symlink(os.path.join(REPO_DIR, name), link)
+
+
+def run_stage(command, work_dir, log_path):
+    # Run a stage in a child process in the workspace, returning its
+    # wall-clock time in seconds and peak memory in MB. Its output goes to a
+    # log file.
+    started = time.perf_counter()
+    with open(log_path, "w") as log:
+        process = subprocess.Popen(
+            command, cwd=work_dir, stdout=log, stderr=subprocess.STDOUT
+        )
+        _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - started
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError(f"Stage failed, see {log_path}: {' '.join(command)}")
+    # ru_maxrss is in kilobytes on Linux
+    return seconds, usage.ru_maxrss / 1024
+
+
+# Stages in place of other images
+
+
+def generate_cohort(source_dir, output_dir, study_name, index_date_range=None):
+    # extract_monthly.py in place of cohortextractor generate_cohort. A study
+    # without an index date range is extracted at its own index date, and
+    # written without the date in its name, as by cohortextractor.
+    if index_date_range is None:
+        index_dates = [load_study(study_name).index_date]
+    else:
+        index_dates = generate_date_range(index_date_range)
+    paths, _, _ = extract_monthly(
+        [study_name], index_dates, load_source(source_dir), output_dir
+    )
+    if index_date_range is None:
+        (path,) = paths
+        suffix = study_suffix(study_name)
+        os.replace(path, os.path.join(output_dir, f"input{suffix}.feather"))
+
+
+def join_cohorts(lhs, rhs, output_dir):
+    # Left join of the rhs cohort onto each cohort matching lhs, as
+    # cohort-joiner does in the join_ethnicity action
+    os.makedirs(output_dir, exist_ok=True)
+    lookup = read_feather(rhs)
+    for path in glob.glob(lhs):
+        if os.path.samefile(path, rhs):
+            continue
+        df = read_feather(path).merge(lookup, on="patient_id", how="left")
+        df.to_feather(os.path.join(output_dir, os.path.basename(path)))
+
+
+INLINE_STAGES = {"generate_cohort": generate_cohort, "join_cohorts": join_cohorts}
+
+
+def find_regressions(results, baseline, tolerance):
+    merged = results.merge(baseline, on=["size", "stage"], suffixes=("", "_baseline"))
+    regressions = []
+    for measure in ["seconds", "peak_memory_mb"]:
+        slower = merged[measure] > merged[f"{measure}_baseline"] * (1 + tolerance)
+        for row in merged[slower].itertuples():
+            regressions.append(
+                f"{row.stage} ({row.size} patients): {measure} "
+                f"{getattr(row, f'{measure}_baseline'):.1f} -> {getattr(row, measure):.1f}"
+            )
+    return regressions
+
+
+def benchmark(sizes, output_dir, index_date_range):
+    results = []
+    for size in sizes:
+        work_dir = os.path.join(output_dir, str(size))
+        make_workspace(work_dir)
+        for stage, command in pipeline_stages(size, index_date_range):
+            log_path = os.path.join(work_dir, "logs", f"{stage}.log")
+            seconds, peak_memory = run_stage(command, work_dir, log_path)
+            print(f"{size:>10} {stage:<45} {seconds:>9.1f}s {peak_memory:>9.0f}MB")
+            results.append(
+                {
+                    "size": size,
+                    "stage": stage,
+                    "seconds": seconds,
+                    "peak_memory_mb": peak_memory,
+                }
+            )
+    return pd.DataFrame(results)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline stages on synthetic populations"
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000])
+    parser.add_argument("--output-dir", default="output/benchmark")
+    parser.add_argument(
+        "--index-date-range",
+        help="Index dates of the monthly cohorts, instead of those in project.yaml",
+    )
+    parser.add_argument("--baseline", help="benchmark.csv of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--run-stage", nargs="+", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.run_stage:
+        stage, *arguments = args.run_stage
+        INLINE_STAGES[stage](*arguments)
+        return
+    output_dir = os.path.abspath(args.output_dir)
+    results = benchmark(args.sizes, output_dir, args.index_date_range)
+    path = os.path.join(output_dir, "benchmark.csv")
+    results.to_csv(path, index=False)
+    print(f"Wrote results to {path}")
+    if args.baseline:
+        regressions = find_regressions(
+            results, pd.read_csv(args.baseline), args.tolerance
+        )
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+# Storage of the monthly cohorts of a study as keyframes and deltas
+#
+# Consecutive monthly cohorts (input_hyp003_2020-03-01.feather,
+# input_hyp003_2020-04-01.feather, ...) are the same for most patients. This
+# script packs them into a store holding a full cohort every
+# --keyframe-interval months (input_<study>_<date>.base.feather) and, for the
+# months in between, only the cells that differ from the month before
+# (input_<study>_<date>.delta.feather). A delta has a single row, with the
+# patients that left the population (`_removed`) and joined it (`_added`), a
+# bitmap of the rows of the month with any change (`_changed`, including the
+# rows of the patients that joined), and for each column with changes a
+# bitmap of which of those rows changed in the column (`_changed:<column>`)
+# and a list of their new values. The categories of each categorical column are
+# kept in its metadata, so every month gets back its own categories. A month is
+# stored as a keyframe instead when its columns or their types changed, or
+# when its delta would be no smaller than the cohort itself (e.g. for
+# cohortextractor's dummy data, which is drawn again every month).
+#
+# read_month() rebuilds any month from the keyframe before it and the deltas
+# in between, reading only the requested columns, and iter_months() rebuilds
+# every month in order, applying each delta once. Keyframes are stored, and
+# cohorts rebuilt, sorted by patient_id with the columns in their original
+# order. The unpack command writes the full monthly cohorts back, for the
+# actions that read input_*.feather.
+#
+# Usage:
+# python analysis/cohort_deltas.py pack \
+#   --study-definition study_definition_hyp003 \
+#   --input-dir output/indicators/joined \
+#   --store-dir output/indicators/deltas
+# python analysis/cohort_deltas.py unpack \
+#   --study-definition study_definition_hyp003 \
+#   --store-dir output/indicators/deltas \
+#   --output-dir output/indicators/joined
+
+import argparse
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from feather_io import cohort_columns, read_feather, read_table
+from generate_measures import cohort_files, study_suffix
+
+STORE_RE = re.compile(
+    r"^input(?P<suffix>.*)_(?P<date>\d{4}-\d{2}-\d{2})\.(?P<kind>base|delta)\.feather$"
+)
+
+ADDED = "_added"
+REMOVED = "_removed"
+CHANGED = "_changed"
+CATEGORIES_KEY = b"categories"
+
+
+def store_path(store_dir, suffix, date, kind):
+    return os.path.join(store_dir, f"input{suffix}_{date}.{kind}.feather")
+
+
+def store_files(store_dir, suffix):
+    # (date, kind, path) of every file of a study in the store, in date order
+    files = []
+    for file in os.listdir(store_dir):
+        match = STORE_RE.match(file)
+        if match and match.group("suffix") == suffix:
+            files.append(
+                (
+                    match.group("date"),
+                    match.group("kind"),
+                    os.path.join(store_dir, file),
+                )
+            )
+    return sorted(files)
+
+
+def changed_column(column):
+    return f"_changed:{column}"
+
+
+def sort_cohort(df):
+    order = np.argsort(df["patient_id"].to_numpy(), kind="stable")
+    return df.iloc[order].reset_index(drop=True)
+
+
+def _comparable(values):
+    # Categoricals are compared by value, as their categories may differ
+    # between months of cohorts written by cohortextractor
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.astype(object).to_numpy()
+    return values.to_numpy()
+
+
+def same_layout(previous, current):
+    # Whether a month can be stored as a delta from the month before: the
+    # same columns of the same types, except for the categories
+    if list(previous.columns) != list(current.columns):
+        return False
+    for column in current.columns:
+        before, after = previous[column].dtype, current[column].dtype
+        if isinstance(before, pd.CategoricalDtype) and isinstance(
+            after, pd.CategoricalDtype
+        ):
+            continue
+        if before != after or not isinstance(after, np.dtype):
+            return False
+    return True
+
+
+def _list(values):
+    # A single list of values, with missing values as nulls
+    return pa.ListArray.from_arrays(
+        pa.array([0, len(values)], pa.int32()), pa.array(values, from_pandas=True)
+    )
+
+
+def delta(previous, current):
+    # Changes from the cohort of the previous month to the current one, both
+    # sorted by patient_id, as a table of one row
+    before_ids = previous["patient_id"].to_numpy()
+    after_ids = current["patient_id"].to_numpy()
+    _, before, after = np.intersect1d(
+        before_ids, after_ids, assume_unique=True, return_indices=True
+    )
+    added = np.ones(len(after_ids), dtype=bool)
+    added[after] = False
+    removed = np.ones(len(before_ids), dtype=bool)
+    removed[before] = False
+    changes = {}
+    categories = {}
+    for column in current.columns.drop("patient_id"):
+        if isinstance(current[column].dtype, pd.CategoricalDtype):
+            categories[column] = current[column].cat.categories.tolist()
+        a = _comparable(previous[column])[before]
+        b = _comparable(current[column])[after]
+        differs = (a != b) & ~(pd.isna(a) & pd.isna(b))
+        changed = added.copy()
+        changed[after[differs]] = True
+        if changed.any():
+            changes[column] = changed
+    # Bitmaps of the rows with changes, then of the changes in each column
+    # among those rows, so that columns changing in the same few rows (e.g.
+    # a date and its value) cost a few bits each
+    rows = np.zeros(len(after_ids), dtype=bool)
+    for changed in changes.values():
+        rows |= changed
+    arrays = {
+        ADDED: _list(after_ids[added]),
+        REMOVED: _list(before_ids[removed]),
+        CHANGED: _list(rows),
+    }
+    for column, changed in changes.items():
+        arrays[changed_column(column)] = _list(changed[rows])
+        arrays[column] = _list(_comparable(current[column])[changed])
+    table = pa.table(arrays)
+    return table.replace_schema_metadata(
+        {CATEGORIES_KEY: json.dumps(categories).encode()}
+    )
+
+
+def _values(table, name):
+    return table[name].chunk(0).flatten().to_numpy(zero_copy_only=False)
+
+
+def apply_delta(state, table):
+    # Cohort of the next month from the cohort of the month before and the
+    # delta between them (with the columns of the state)
+    ids = state["patient_id"].to_numpy()
+    kept = ~np.isin(ids, _values(table, REMOVED))
+    ids = ids[kept]
+    new_ids = np.sort(np.concatenate([ids, _values(table, ADDED)]))
+    positions = np.searchsorted(new_ids, ids)
+    categories = json.loads(table.schema.metadata[CATEGORIES_KEY])
+    rows = np.flatnonzero(_values(table, CHANGED))
+    data = {"patient_id": new_ids}
+    for column in state.columns.drop("patient_id"):
+        if column in table.column_names:
+            changed = rows[_values(table, changed_column(column))]
+            values = _values(table, column)
+        else:
+            changed = rows[:0]
+            values = []
+        if column in categories:
+            dtype = pd.CategoricalDtype(
+                categories[column], ordered=state[column].dtype.ordered
+            )
+            codes = np.full(len(new_ids), -1, dtype=np.int64)
+            codes[positions] = state[column].astype(dtype).cat.codes.to_numpy()[kept]
+            codes[changed] = dtype.categories.get_indexer(values)
+            data[column] = pd.Categorical.from_codes(codes, dtype=dtype)
+        else:
+            previous = state[column].to_numpy()
+            data[column] = np.empty(len(new_ids), dtype=previous.dtype)
+            data[column][positions] = previous[kept]
+            data[column][changed] = values
+    return pd.DataFrame(data, columns=state.columns)
+
+
+def _write_table(table, path):
+    options = pa.ipc.IpcWriteOptions(compression="zstd")
+    with pa.OSFile(f"{path}.tmp", "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema, options=options) as writer:
+            writer.write_table(table)
+    os.replace(f"{path}.tmp", path)
+
+
+def _table_size(table):
+    options = pa.ipc.IpcWriteOptions(compression="zstd")
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_file(sink, table.schema, options=options) as writer:
+        writer.write_table(table)
+    return sink.getvalue().size
+
+
+def pack_cohorts(input_dir, store_dir, study_name, keyframe_interval=12):
+    # Writes the store of a study from its monthly cohorts; returns the size
+    # of the cohorts and of the store in bytes
+    suffix = study_suffix(study_name)
+    os.makedirs(store_dir, exist_ok=True)
+    previous = None
+    input_bytes = store_bytes = 0
+    cohorts = cohort_files(input_dir, suffix)
+    for i, (date, path) in enumerate(cohorts):
+        current = sort_cohort(read_feather(path))
+        input_bytes += os.path.getsize(path)
+        # A keyframe is written when the columns change, e.g. after a
+        # variable was added to the study definition
+        kind = "base"
+        rows = pa.Table.from_pandas(current, preserve_index=False)
+        if (
+            previous is not None
+            and i % keyframe_interval != 0
+            and same_layout(previous, current)
+        ):
+            changes = delta(previous, current)
+            if _table_size(changes) < _table_size(rows):
+                kind = "delta"
+                rows = changes
+        for stale in ("base", "delta"):
+            stale_path = store_path(store_dir, suffix, date, stale)
+            if stale != kind and os.path.exists(stale_path):
+                os.remove(stale_path)
+        out_path = store_path(store_dir, suffix, date, kind)
+        _write_table(rows, out_path)
+        store_bytes += os.path.getsize(out_path)
+        previous = current
+    # Months that are no longer among the cohorts would otherwise be replayed
+    # by iter_months() and unpack
+    dates = {date for date, _ in cohorts}
+    for date, _, path in store_files(store_dir, suffix):
+        if date not in dates:
+            os.remove(path)
+    return input_bytes, store_bytes
+
+
+def replay(files, columns=None):
+    # (date, cohort) of each file in turn, starting from a keyframe
+    if columns is not None:
+        columns = list(dict.fromkeys(["patient_id", *columns]))
+    state = None
+    for date, kind, path in files:
+        if kind == "base":
+            state = read_feather(path, columns=columns)
+        elif state is None:
+            raise ValueError(f"No keyframe before {path}")
+        else:
+            # Columns without changes are left out of a delta
+            stored = set(cohort_columns(path))
+            names = [ADDED, REMOVED, CHANGED]
+            for column in state.columns.drop("patient_id"):
+                if column in stored:
+                    names += [column, changed_column(column)]
+            state = apply_delta(state, read_table(path, columns=names))
+        yield date, state
+
+
+def iter_months(store_dir, study_name, columns=None):
+    # (date, cohort) of every month of a study in the store, in date order
+    files = store_files(store_dir, study_suffix(study_name))
+    yield from replay(files, columns)
+
+
+def read_month(store_dir, study_name, date, columns=None):
+    # Cohort of one month, rebuilt from the keyframe before it
+    files = store_files(store_dir, study_suffix(study_name))
+    if date not in {file_date for file_date, _, _ in files}:
+        raise FileNotFoundError(f"No cohort of {study_name} for {date} in {store_dir}")
+    start = max(d for d, kind, _ in files if kind == "base" and d <= date)
+    files = [file for file in files if start <= file[0] <= date]
+    for file_date, state in replay(files, columns):
+        if file_date == date:
+            return state
+
+
+def unpack_cohorts(store_dir, output_dir, study_name):
+    suffix = study_suffix(study_name)
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for date, df in iter_months(store_dir, study_name):
+        path = os.path.join(output_dir, f"input{suffix}_{date}.feather")
+        df.to_feather(f"{path}.tmp", compression="zstd")
+        os.replace(f"{path}.tmp", path)
+        paths.append(path)
+    return paths
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Pack monthly cohorts into keyframes and deltas, or unpack them"
+    )
+    parser.add_argument("command", choices=["pack", "unpack"])
+    parser.add_argument("--study-definition", required=True, nargs="+")
+    parser.add_argument("--input-dir", default="output/indicators/joined")
+    parser.add_argument("--store-dir", default="output/indicators/deltas")
+    parser.add_argument("--output-dir", default="output/indicators/joined")
+    parser.add_argument(
+        "--keyframe-interval",
+        type=int,
+        default=12,
+        help="Number of months between full cohorts in the store",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    for study_name in args.study_definition:
+        if args.command == "pack":
+            input_bytes, store_bytes = pack_cohorts(
+                args.input_dir, args.store_dir, study_name, args.keyframe_interval
+            )
+            print(
+                f"Packed {study_name}: {input_bytes / 1e6:.1f} MB of cohorts "
+                f"into {store_bytes / 1e6:.1f} MB"
+            )
+        else:
+            paths = unpack_cohorts(args.store_dir, args.output_dir, study_name)
+            print(f"Unpacked {len(paths)} cohorts of {study_name} to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# Date helpers shared by the local extraction scripts
+#
+# Dates are held as days since 1970-01-01 in int64 arrays. Missing dates sort
+# before any real date, which matches cohortextractor comparing empty date
+# strings ('') in `patients.satisfying()` expressions.
+
+import datetime
+import re
+
+import numpy as np
+import pandas as pd
+
+MISSING_DATE = np.iinfo(np.int64).min
+OPEN_END_DATE = np.iinfo(np.int64).max
+
+# Column references in date bounds, e.g. "hyp_invite_1_date + 7 days"
+COLUMN_DATE_RE = re.compile(
+    r"^(?P<column>\w+)(\s*(?P<op>[+-])\s*(?P<n>\d+)\s*(?P<unit>day|month|year)s?)?$"
+)
+
+ISO_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+def generate_date_range(date_range):
+    # Same format as the --index-date-range argument of cohortextractor,
+    # returned in ascending order
+    if " to " not in date_range:
+        return [date_range]
+    start, end = date_range.split(" to ", 1)
+    period = "month"
+    if " by " in end:
+        end, period = end.split(" by ", 1)
+    if period != "month":
+        raise ValueError(f"Unsupported period '{period}': must be 'month'")
+    date = datetime.date.fromisoformat(start)
+    end = datetime.date.fromisoformat(end)
+    dates = []
+    while date <= end:
+        dates.append(date.isoformat())
+        if date.month < 12:
+            date = date.replace(month=date.month + 1)
+        else:
+            date = date.replace(year=date.year + 1, month=1)
+    return dates
+
+
+def to_days(values):
+    # Convert dates (strings, datetimes or None) to days since 1970-01-01
+    days = pd.to_datetime(values).to_numpy().astype("datetime64[D]")
+    return days.astype(np.int64)
+
+
+def date_to_days(date):
+    return np.datetime64(date, "D").astype(np.int64)
+
+
+def days_to_datetime(days):
+    # Convert days back to a datetime series with NaT for missing dates
+    dates = days.astype("datetime64[D]").astype("datetime64[ns]")
+    return pd.Series(dates).where(days != MISSING_DATE)
+
+
+def shift_days(days, op, n, unit):
+    # Add or subtract days, months or years, keeping missing dates missing
+    n = n if op == "+" else -n
+    missing = days == MISSING_DATE
+    dates = days.copy()
+    dates[missing] = 0
+    dates = dates.astype("datetime64[D]")
+    if unit == "day":
+        shifted = dates + np.timedelta64(n, "D")
+    else:
+        months = n if unit == "month" else 12 * n
+        month_start = dates.astype("datetime64[M]")
+        day_of_month = dates - month_start
+        new_month = month_start + np.timedelta64(months, "M")
+        month_length = (new_month + np.timedelta64(1, "M")).astype(
+            "datetime64[D]"
+        ) - new_month.astype("datetime64[D]")
+        shifted = new_month.astype("datetime64[D]") + np.minimum(
+            day_of_month, month_length - np.timedelta64(1, "D")
+        )
+    shifted = shifted.astype(np.int64)
+    shifted[missing] = MISSING_DATE
+    return shifted
@@ -0,0 +1,93 @@
+# This script calculates the deciles of the practice level measures of every
+# indicator for each month, replacing the deciles tables of the
+# generate_deciles action and join_deciles.R
+#
+# The practice measures of all indicators (only the date, denominator and
+# value columns) are stacked and the deciles of every indicator and month are
+# calculated in a single grouped quantile, the same way as deciles-charts:
+# practices with a zero denominator are left out and the deciles are linearly
+# interpolated. The result is one table with the columns indicator, date,
+# percentile and value.
+#
+# Usage:
+# python analysis/deciles.py \
+#   --input-dir output/indicators/joined \
+#   --output-dir output/indicators/joined/deciles
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from join_measures import INDICATORS
+
+# Practice level measure of each indicator
+PRACTICE_MEASURES = {
+    "hyp001": "hyp001_prevalence_practice_breakdown_rate",
+    "hyp003": "hyp003_achievem_practice_breakdown_rate",
+    "hyp007": "hyp007_achievem_practice_breakdown_rate",
+    "bp002_1y_hypreg": "bp002_1y_achievem_hypreg_practice_breakdown_rate",
+}
+
+DECILES = np.arange(1, 10) / 10
+
+
+def load_practice_measure(input_dir, name):
+    denominator = INDICATORS[name]["denominator"]
+    path = os.path.join(input_dir, f"measure_{PRACTICE_MEASURES[name]}.csv")
+    df = pd.read_csv(path, usecols=["date", denominator, "value"])
+    df = df[df[denominator] > 0]
+    return pd.DataFrame(
+        {
+            "indicator": pd.Categorical(
+                np.repeat(name, len(df)), categories=list(PRACTICE_MEASURES)
+            ),
+            "date": df["date"].to_numpy(),
+            "value": df["value"].to_numpy(dtype=float),
+        }
+    )
+
+
+def calculate_deciles(input_dir, indicators):
+    df = pd.concat(
+        [load_practice_measure(input_dir, name) for name in indicators],
+        ignore_index=True,
+    )
+    deciles = (
+        df.groupby(["indicator", "date"], observed=True)["value"]
+        .quantile(DECILES)
+        .rename_axis(["indicator", "date", "percentile"])
+        .reset_index()
+    )
+    deciles["indicator"] = deciles["indicator"].astype(str)
+    deciles["percentile"] = (deciles["percentile"] * 100).round().astype(int)
+    return deciles
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Calculate the deciles of the practice level measures"
+    )
+    parser.add_argument("--input-dir", default="output/indicators/joined")
+    parser.add_argument("--output-dir", default="output/indicators/joined/deciles")
+    parser.add_argument(
+        "--indicator",
+        nargs="+",
+        choices=list(PRACTICE_MEASURES),
+        default=list(PRACTICE_MEASURES),
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    deciles = calculate_deciles(args.input_dir, args.indicator)
+    path = os.path.join(args.output_dir, "deciles_hyp_practice.csv")
+    deciles.to_csv(path, index=False)
+    print(f"Wrote {len(deciles)} deciles to {path}")
+
+
+if __name__ == "__main__":
+    main()
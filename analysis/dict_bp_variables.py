@@ -1,8 +1,6 @@
 # Define common variables needed across indicators here
 # See https://docs.opensafely.org/study-def-tricks/
 
-import pandas as pd
-from config import start_date, end_date
 from cohortextractor import patients
 from codelists import (
     bp_codes,
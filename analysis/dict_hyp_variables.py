@@ -1,7 +1,5 @@
 # Define common variables needed across indicators here
 # See https://docs.opensafely.org/study-def-tricks/
-import pandas as pd
-from config import start_date, end_date
 from cohortextractor import patients
 from codelists import (
     hyp_codes,
@@ -16,9 +14,7 @@ from codelists import (
 )
 
 # Define unique list of hypertension codes to set expectations in dummy data
-hyp_codes_path = "codelists/nhsd-primary-care-domain-refsets-hyp_cod.csv"
-hyp_codes_df = pd.read_csv(hyp_codes_path)
-hyp_codes_unique = hyp_codes_df["code"].unique()
+hyp_codes_unique = list(dict.fromkeys(hyp_codes))
 
 # Define dictionary of variables needed for hypertension register:
 # Patients with an unresolved diagnosis of hypertension
@@ -0,0 +1,49 @@
+# Disclosure control of measures
+#
+# Two steps are applied before measures are released:
+# - small number suppression, exactly as `Measure._suppress_column` in
+#   cohortextractor does for measures with `small_number_suppression=True`
+# - rounding of counts to the nearest 10, as join_measures.py does, with the
+#   value recalculated from the rounded counts
+#
+# Both work on one chunk of measures at a time (one measure for suppression,
+# any rows for rounding), so they can be applied as measures are produced
+# rather than to fully materialised files.
+
+import numpy as np
+
+SMALL_NUMBER_THRESHOLD = 5
+
+# Counts are rounded to a multiple of 10
+ROUNDING_DECIMALS = -1
+
+
+def suppress_small_numbers(values):
+    # Values of 1 to 5 are suppressed and, if they total 5 or less, so are
+    # all values equal to the next smallest one
+    values = values.astype(float)
+    small = (values > 0) & (values <= SMALL_NUMBER_THRESHOLD)
+    large = values > SMALL_NUMBER_THRESHOLD
+    if not small.any():
+        return values
+    small_total = values[small].sum()
+    values[small] = np.nan
+    if small_total <= SMALL_NUMBER_THRESHOLD and large.any():
+        values[values == values[large].min()] = np.nan
+    return values
+
+
+def round_counts(values):
+    # Counts rounded to the nearest 10, keeping suppressed counts missing
+    return np.round(np.asarray(values, dtype=float), ROUNDING_DECIMALS)
+
+
+def release(chunk, numerator="numerator", denominator="denominator"):
+    # Measures ready for release: rounded counts, and the value recalculated
+    # from them
+    chunk = chunk.copy()
+    chunk[numerator] = round_counts(chunk[numerator])
+    chunk[denominator] = round_counts(chunk[denominator])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        chunk["value"] = chunk[numerator] / chunk[denominator]
+    return chunk
@@ -0,0 +1,457 @@
+# Dummy monthly cohorts at any population size, from the expectations of the
+# study definitions
+#
+# `cohortextractor generate_cohort` without a database draws dummy data for
+# each variable independently from its `return_expectations` (merged into the
+# study's `default_expectations`), separately for every index date. This
+# script generates the same `input_<study>_<date>.feather` files from the
+# same expectations, vectorised over all patients, with a few differences
+# that make the cohorts usable for load testing the measures and join stages:
+#
+# - Patients keep their identity across months. Draws are a hash of the
+#   patient, the variable and a version that changes once a year at a
+#   different month for each patient, so each month about 1/12 of the
+#   patients get new clinical events. Demographics never change and ages
+#   increase with the index date.
+# - As the period of a variable moves with the index date, its events fall
+#   in or out of it, as they would in real data.
+# - Whether a patient has events is correlated across variables through a
+#   per-patient latent "activity", so e.g. patients with a hypertension
+#   diagnosis are more likely to have blood pressure readings.
+# - Recorded values (e.g. blood pressure) of patients on the hypertension
+#   register are drawn REGISTER_VALUE_SHIFT standard deviations higher than
+#   their expectations, so blood pressure control rules give plausible rates
+#   for registered patients.
+# - Rules (`patients.categorised_as()` and `patients.satisfying()`) are
+#   evaluated from the generated variables by the rule engine rather than
+#   drawn from their own expectations, so registers, denominators and
+#   numerators are consistent with the variables they are built from.
+#
+# With --join-ethnicity, the columns of an ethnicity cohort (e.g. a dummy
+# study_definition_ethnicity cohort) are joined onto each cohort as in
+# extract_monthly.py, so the cohorts can go straight to the measures.
+#
+# Draws are not stored, so memory use is bounded by the columns of the
+# cohort being generated, and any month can be generated on its own.
+#
+# Usage:
+# python analysis/dummy_cohorts.py \
+#   --study-definition study_definition_hyp003 \
+#   --index-date-range "2019-03-01 to 2023-03-31 by month" \
+#   --size 1000000 \
+#   --output-dir output/indicators
+
+import argparse
+import os
+import zlib
+
+import numpy as np
+
+from date_utils import MISSING_DATE, date_to_days, generate_date_range
+from extract_monthly import (
+    CohortEngine,
+    join_lookup,
+    load_lookup,
+    load_study,
+    output_path,
+    required_variables,
+    to_dataframe,
+)
+from rule_engine import RuleProgram
+
+# Months between changes of a patient's clinical events
+CHANGE_PERIOD = 12
+
+# Correlation between the latent activity of a patient and their events
+ACTIVITY_CORRELATION = 0.5
+
+# Register whose patients have higher recorded values, and by how many
+# standard deviations of the expected values
+REGISTER = "hyp_reg"
+REGISTER_VALUE_SHIFT = 0.5
+
+# Maximum index of multiple deprivation rank, as used by imd_q5
+IMD_MAX = 32844
+
+# Variables that never change for a patient
+STABLE_TYPES = {"sex", "age_as_of", "registered_practice_as_of", "address_as_of"}
+
+# Ages are drawn at this date and increase from there
+AGE_EPOCH = date_to_days("2019-01-01")
+
+# UK population (thousands) by 5 year age band, ONS 2018 principal projection,
+# the same bands cohortextractor draws dummy ages from
+UK_POPULATION_BANDS = [
+    (0, 3914),
+    (5, 4139),
+    (10, 3859),
+    (15, 3669),
+    (20, 4185),
+    (25, 4527),
+    (30, 4463),
+    (35, 4372),
+    (40, 3993),
+    (45, 4507),
+    (50, 4674),
+    (55, 4294),
+    (60, 3673),
+    (65, 3396),
+    (70, 3252),
+    (75, 2236),
+    (80, 1673),
+    (85, 1024),
+    (90, 448),
+    (95, 123),
+    (100, 13),
+]
+MAX_AGE = 110
+
+_MASK = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+
+def merge_expectations(default, expectations):
+    # Same as cohortextractor: a recursive merge of the variable's
+    # expectations into the study's default expectations
+    merged = dict(default)
+    for key, value in (expectations or {}).items():
+        if isinstance(value, dict):
+            value = merge_expectations(merged.get(key) or {}, value)
+        merged[key] = value
+    return merged
+
+
+def splitmix64(keys):
+    # Well mixed 64-bit hashes of 64-bit keys
+    with np.errstate(over="ignore"):
+        z = keys + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return (z ^ (z >> np.uint64(31))) & _MASK
+
+
+def uk_population_age(u):
+    # Ages (in fractional years) at the quantiles `u` of the UK population,
+    # uniform within each age band
+    starts = np.array([start for start, _ in UK_POPULATION_BANDS], dtype=float)
+    ends = np.append(starts[1:], MAX_AGE)
+    counts = np.array([count for _, count in UK_POPULATION_BANDS], dtype=float)
+    cumulative = np.cumsum(counts) / counts.sum()
+    band = np.minimum(np.searchsorted(cumulative, u, side="right"), len(counts) - 1)
+    lower = np.where(band > 0, cumulative[band - 1], 0.0)
+    within = (u - lower) / (cumulative[band] - lower)
+    return starts[band] + within * (ends[band] - starts[band])
+
+
+class DummySource:
+    # Patients of the dummy population, with the same ids in every month
+    def __init__(self, size):
+        self.size = size
+        self.patient_id = np.arange(1, size + 1, dtype=np.int64)
+
+
+class DummyEngine(CohortEngine):
+    # Evaluates the covariate definitions of a study definition for an index
+    # date by drawing each input variable from its expectations, and the rules
+    # from those variables as the local extraction does
+    def __init__(self, size, seed=0):
+        super().__init__(DummySource(size))
+        self.seed = seed
+        self.patients = self.source.patient_id.astype(np.uint64)
+        self.activity = self._normal("activity", 0)
+        self.month = 0
+        self.register = None
+
+    def set_index_date(self, index_date):
+        year, month = index_date[:4], index_date[5:7]
+        self.month = int(year) * 12 + int(month)
+        self.reset_shared()
+
+    def evaluate(self, covariate_definitions, program=None, default_expectations=None):
+        self.expectations = {}
+        for name, (query_type, query_args) in covariate_definitions.items():
+            if query_type == "value_from":
+                continue
+            self.expectations[name] = merge_expectations(
+                default_expectations or {}, query_args.get("return_expectations")
+            )
+        # The register is evaluated first, so that recorded values can depend
+        # on it. Its variables are then reused by the full evaluation.
+        self.register = None
+        if REGISTER in covariate_definitions:
+            required = required_variables(covariate_definitions, {REGISTER})
+            register_definitions = {
+                name: definition
+                for name, definition in covariate_definitions.items()
+                if name in required
+            }
+            columns = super().evaluate(register_definitions, program)
+            self.register = columns[REGISTER]
+        return super().evaluate(covariate_definitions, program)
+
+    # Draws
+
+    def _uniform(self, name, stream, version=0):
+        # Uniform draws in [0, 1) per patient, the same for the same variable,
+        # stream and version whatever the population size or index date
+        key = zlib.crc32(f"{self.seed}:{name}:{stream}".encode())
+        keys = splitmix64(self.patients ^ splitmix64(np.uint64(key)))
+        keys = splitmix64(keys ^ np.asarray(version, dtype=np.uint64))
+        return (keys >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+    def _normal(self, name, stream, version=0):
+        # Box-Muller transform of two uniform draws
+        u1 = self._uniform(name, f"{stream}a", version)
+        u2 = self._uniform(name, f"{stream}b", version)
+        return np.sqrt(-2 * np.log1p(-u1)) * np.cos(2 * np.pi * u2)
+
+    def _version(self, name, query_type):
+        # Each patient's clinical events change every CHANGE_PERIOD months,
+        # at a month of their own
+        if query_type in STABLE_TYPES:
+            return np.zeros(self.source.size, dtype=np.int64)
+        phase = (self._uniform(name, "phase") * CHANGE_PERIOD).astype(np.int64)
+        return (self.month + phase) // CHANGE_PERIOD + 1
+
+    def _present(self, name, expectations, version):
+        # Patients with a value, in the proportion given by the incidence.
+        # Patients with a higher latent activity are more likely to have one.
+        if expectations.get("rate") == "universal":
+            return np.ones(self.source.size, dtype=bool)
+        incidence = expectations.get("incidence")
+        if incidence is None:
+            raise ValueError(f"No incidence in the expectations of '{name}'")
+        if incidence >= 1:
+            return np.ones(self.source.size, dtype=bool)
+        noise = self._normal(name, "present", version)
+        score = (
+            ACTIVITY_CORRELATION * self.activity
+            + np.sqrt(1 - ACTIVITY_CORRELATION**2) * noise
+        )
+        return score > np.quantile(score, 1 - incidence)
+
+    def _dates(self, name, expectations, version):
+        # Dates between the earliest and latest expected dates, uniform or
+        # increasingly common towards the latest date
+        dates = expectations.get("date") or {}
+        earliest = date_to_days(dates["earliest"])
+        latest = date_to_days(dates["latest"])
+        u = self._uniform(name, "date", version)
+        if expectations.get("rate") == "exponential_increase":
+            # Inverse of the exponential distribution with the same scale as
+            # cohortextractor's, truncated to the expected dates
+            u = -0.1 * np.log1p(-u * (1 - np.exp(-10)))
+            return latest - (u * (latest - earliest)).astype(np.int64)
+        return earliest + (u * (latest - earliest + 1)).astype(np.int64)
+
+    def _values(self, name, expectations, version, empty, shift=0):
+        # Values of the expected type: a category, an int or a float. Normal
+        # values can be shifted by a number of standard deviations.
+        if "category" in expectations:
+            ratios = expectations["category"]["ratios"]
+            categories = np.array(list(ratios), dtype=object)
+            cumulative = np.cumsum(list(ratios.values()), dtype=float)
+            u = self._uniform(name, "value", version) * cumulative[-1]
+            return categories[np.searchsorted(cumulative, u, side="right")]
+        for value_type in ["int", "float"]:
+            distribution = expectations.get(value_type)
+            if distribution is None:
+                continue
+            kind = distribution["distribution"]
+            if kind == "normal":
+                z = self._normal(name, "value", version) + shift
+                values = distribution["mean"] + distribution["stddev"] * z
+            elif kind == "poisson":
+                # Normal approximation, which is close enough for dummy data
+                z = self._normal(name, "value", version)
+                mean = distribution["mean"]
+                values = np.maximum(np.round(mean + np.sqrt(mean) * z), 0)
+            else:
+                raise ValueError(f"Unsupported distribution '{kind}' for '{name}'")
+            return values.astype(np.int64) if value_type == "int" else values
+        return np.full(self.source.size, empty)
+
+    def _events(self, name, between, query_type="with_these_clinical_events"):
+        # Whether each patient has an event in the period, and its date
+        expectations = self.expectations[name]
+        version = self._version(name, query_type)
+        present = self._present(name, expectations, version)
+        dates = self._dates(name, expectations, version)
+        start, end = self._window(between)
+        present &= (dates >= start) & (dates <= end)
+        self.dates[name] = np.where(present, dates, MISSING_DATE)
+        return present, version
+
+    def _variable(self, name, query_type, empty):
+        # Flags are whether the patient has a value, other variables are
+        # values of their expected type
+        expectations = self.expectations[name]
+        version = self._version(name, query_type)
+        present = self._present(name, expectations, version)
+        if empty is False:
+            return present
+        values = self._values(name, expectations, version, empty)
+        return np.where(present, values, empty)
+
+    # Demographics and registration
+
+    def patients_sex(self, name, **kwargs):
+        return self._variable(name, "sex", "")
+
+    def patients_age_as_of(self, name, reference_date, **kwargs):
+        age = uk_population_age(self._uniform(name, "age"))
+        years = (date_to_days(reference_date) - AGE_EPOCH) / 365.25
+        return np.floor(age + years).astype(np.int64)
+
+    def patients_died_from_any_cause(self, name, between, **kwargs):
+        present, _ = self._events(name, between, "died_from_any_cause")
+        return present
+
+    def patients_registered_as_of(self, name, **kwargs):
+        return self._variable(name, "registered_as_of", False)
+
+    def patients_registered_with_one_practice_between(self, name, **kwargs):
+        return self._variable(name, "registered_with_one_practice_between", False)
+
+    def patients_registered_practice_as_of(self, name, returning, **kwargs):
+        empty = "" if returning == "nuts1_region_name" else 0
+        return self._variable(name, "registered_practice_as_of", empty)
+
+    def patients_address_as_of(self, name, round_to_nearest=None, **kwargs):
+        expectations = self.expectations[name]
+        present = self._present(name, expectations, 0)
+        if "int" in expectations:
+            imd = self._values(name, expectations, 0, -1).astype(float)
+        else:
+            imd = self._uniform(name, "value") * IMD_MAX
+        if round_to_nearest:
+            imd = np.round(imd / round_to_nearest) * round_to_nearest
+        return np.where(present, imd, -1).astype(np.int64)
+
+    # Clinical events
+
+    def patients_with_these_clinical_events(
+        self, name, returning, between=None, **kwargs
+    ):
+        present, version = self._events(name, between)
+        if returning == "binary_flag":
+            return present
+        if returning == "date":
+            return self.dates[name]
+        if returning == "category":
+            values = self._values(name, self.expectations[name], version, "")
+            return np.where(present, values, "")
+        if returning == "number_of_matches_in_period":
+            values = self._values(name, self.expectations[name], version, 1)
+            return np.where(present, np.maximum(values, 1), 0).astype(np.int64)
+        raise ValueError(
+            f"Unsupported returning value '{returning}' for clinical events"
+        )
+
+    def patients_mean_recorded_value(self, name, between, **kwargs):
+        present, version = self._events(name, between)
+        shift = 0 if self.register is None else self.register * REGISTER_VALUE_SHIFT
+        values = self._values(name, self.expectations[name], version, 0.0, shift)
+        return np.where(present, values, 0.0)
+
+
+def expected_code_tables(covariate_definitions, expectations):
+    # Categories of the string columns: the category definitions of rules,
+    # or the expected categories of the other variables
+    tables = {}
+    for name, (query_type, query_args) in covariate_definitions.items():
+        if query_args.get("column_type") != "str":
+            continue
+        if query_type == "categorised_as":
+            categories = query_args["category_definitions"]
+        else:
+            categories = expectations[name].get("category", {}).get("ratios", {})
+        tables[name] = sorted(set(categories) - {""})
+    return tables
+
+
+def generate_dummy_cohorts(
+    study_names,
+    index_dates,
+    size,
+    output_dir,
+    seed=0,
+    compression="zstd",
+    lookup=None,
+):
+    studies = {name: load_study(name) for name in study_names}
+    engine = DummyEngine(size, seed)
+    programs = {}
+    tables = {}
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for index_date in index_dates:
+        engine.set_index_date(index_date)
+        for study_name, study in studies.items():
+            study.set_index_date(index_date)
+            covariate_definitions = study.covariate_definitions
+            if study_name not in programs:
+                programs[study_name] = RuleProgram(covariate_definitions)
+            columns = engine.evaluate(
+                covariate_definitions,
+                programs[study_name],
+                study.default_expectations,
+            )
+            if study_name not in tables:
+                tables[study_name] = expected_code_tables(
+                    covariate_definitions, engine.expectations
+                )
+            df = to_dataframe(
+                engine.source,
+                columns,
+                covariate_definitions,
+                tables=tables[study_name],
+            )
+            if lookup is not None:
+                df = join_lookup(df, lookup)
+            path = output_path(output_dir, study_name, index_date)
+            df.to_feather(f"{path}.tmp", compression=compression)
+            os.replace(f"{path}.tmp", path)
+            paths.append(path)
+    return paths
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Generate dummy monthly cohorts from the expectations of "
+        "one or more study definitions"
+    )
+    parser.add_argument("--study-definition", required=True, nargs="+")
+    parser.add_argument("--index-date-range", required=True)
+    parser.add_argument("--size", type=int, default=10_000)
+    parser.add_argument("--output-dir", default="output/indicators")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--compression",
+        choices=["zstd", "lz4", "uncompressed"],
+        default="zstd",
+    )
+    parser.add_argument(
+        "--join-ethnicity",
+        metavar="PATH",
+        help="Ethnicity cohort to join onto each cohort",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    lookup = load_lookup(args.join_ethnicity) if args.join_ethnicity else None
+    paths = generate_dummy_cohorts(
+        args.study_definition,
+        generate_date_range(args.index_date_range),
+        args.size,
+        args.output_dir,
+        seed=args.seed,
+        compression=args.compression,
+        lookup=lookup,
+    )
+    print(f"Generated {len(paths)} dummy cohorts in {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
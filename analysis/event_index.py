@@ -0,0 +1,130 @@
+# Per-patient date index of the clinical events matching a codelist
+#
+# The QOF variables in dict_hyp_variables.py are all "first/last match in
+# period", "exists in period" or "count in period" queries over a handful of
+# clusters (hyp_codes, bp_sys_codes, hyp_invite_codes, ...), asked again for
+# every monthly index date. The events of a cluster are held sorted by
+# patient and date, with CSR offsets giving each patient's slice of the
+# date array, so that each query is a binary search per patient rather than
+# a scan over every event of the cluster.
+#
+# Searches use a single composite key (patient, date) so that one vectorised
+# `np.searchsorted` call answers the query for all patients at once.
+#
+# Most periods slide forward by a month per index date (e.g. the 12 month
+# lookbacks of bp_sys_val_12m or hyp_pca_dec_12m). A query can name a cursor
+# (the variable it is for), which keeps each patient's position for the
+# period's start and end: when the next month's bound is different, only the
+# positions of the patients with events dated in between are moved, so a
+# sweep over all months touches each event once per bound rather than every
+# patient. Each cursor holds a position per patient, so only the most recently
+# used MAX_CURSORS are kept; a cursor that was dropped starts again from a
+# binary search.
+
+import numpy as np
+
+from date_utils import MISSING_DATE
+
+MAX_CURSORS = 16
+
+
+class EventIndex:
+    def __init__(self, patient, date, size, **columns):
+        # `patient` and `date` must be sorted by patient and then date.
+        # Events without a date never fall within a period, so are dropped.
+        dated = date != MISSING_DATE
+        self.size = size
+        self.patient = patient[dated]
+        self.date = date[dated]
+        self.columns = {name: values[dated] for name, values in columns.items()}
+        self.offsets = np.searchsorted(self.patient, np.arange(size + 1))
+        # Composite keys: dates are shifted to start at 1, leaving room for
+        # bounds just before the first and just after the last date
+        if len(self.date):
+            self.min_date = self.date.min() - 1
+            self.span = self.date.max() - self.min_date + 2
+        else:
+            self.min_date = 0
+            self.span = 2
+        self.keys = self.patient * self.span + (self.date - self.min_date)
+        self._by_date = None
+        self._cursors = {}
+
+    def __len__(self):
+        return len(self.date)
+
+    def _search(self, bound, side, cursor=None):
+        # Position of each patient's bound in the event array. Bounds that
+        # are the same for all patients can use a cursor, whose positions are
+        # updated in place: they are only valid until its next search.
+        if cursor is None or np.ndim(bound):
+            return self._binary_search(bound, side)
+        previous = self._cursors.pop((cursor, side), None)
+        if previous is None:
+            positions = self._binary_search(bound, side)
+        else:
+            previous_bound, positions = previous
+            if bound > previous_bound:
+                patients = self._patients_between(previous_bound, bound, side)
+                np.add.at(positions, patients, 1)
+            elif bound < previous_bound:
+                patients = self._patients_between(bound, previous_bound, side)
+                np.subtract.at(positions, patients, 1)
+        self._cursors[(cursor, side)] = (bound, positions)
+        if len(self._cursors) > MAX_CURSORS:
+            # Dicts keep their order of insertion, so this is the cursor
+            # used least recently
+            del self._cursors[next(iter(self._cursors))]
+        return positions
+
+    def _binary_search(self, bound, side):
+        bound = np.clip(bound, self.min_date, self.min_date + self.span - 1)
+        keys = np.arange(self.size) * self.span + (bound - self.min_date)
+        return np.searchsorted(self.keys, keys, side=side)
+
+    def _patients_between(self, lower, upper, side):
+        # Patient of each event dated in [lower, upper) for the start of a
+        # period, or in (lower, upper] for its end
+        if self._by_date is None:
+            order = np.argsort(self.date, kind="stable")
+            self._by_date = (self.date[order], self.patient[order])
+        dates, patients = self._by_date
+        first = np.searchsorted(dates, lower, side=side)
+        last = np.searchsorted(dates, upper, side=side)
+        return patients[first:last]
+
+    def window(self, start, end, cursor=None):
+        # For each patient, the range [lo, hi) of their events dated within
+        # [start, end]. Bounds are scalars or per-patient arrays of days.
+        lo = self._search(start, "left", cursor)
+        hi = self._search(end, "right", cursor)
+        return lo, np.maximum(hi, lo)
+
+    def first(self, start, end, cursor=None):
+        # Row of each patient's first event in the period, or -1
+        lo, hi = self.window(start, end, cursor)
+        return np.where(hi > lo, lo, -1)
+
+    def last(self, start, end, cursor=None):
+        # Row of each patient's last event in the period, or -1
+        lo, hi = self.window(start, end, cursor)
+        return np.where(hi > lo, hi - 1, -1)
+
+    def count(self, start, end, cursor=None):
+        lo, hi = self.window(start, end, cursor)
+        return hi - lo
+
+    def rows(self, lo, hi):
+        # Patients and rows of every event in the ranges [lo, hi), in order
+        lengths = hi - lo
+        patients = np.repeat(np.arange(self.size), lengths)
+        starts = np.repeat(lo - np.cumsum(lengths) + lengths, lengths)
+        return patients, starts + np.arange(lengths.sum())
+
+    def values_at(self, name, rows, empty):
+        # Per-patient values of a column at the given rows (-1 for none)
+        column = self.date if name == "date" else self.columns[name]
+        values = np.full(self.size, empty, dtype=column.dtype)
+        found = rows >= 0
+        values[found] = column[rows[found]]
+        return values
@@ -0,0 +1,1013 @@
+# Single-pass extraction of monthly cohorts from a local event-level extract
+#
+# `cohortextractor generate_cohort --index-date-range` runs the full study
+# definition once per index date, so every month rescans all clinical events.
+# This script loads the source tables once, keeps each patient's event stream
+# in memory and evaluates every monthly index date from there. It writes the
+# same `input_<study>_<date>.feather` files as cohortextractor, so the
+# measures and join actions can run on its output unchanged.
+#
+# The variable definitions are taken from the study definitions themselves
+# (`study.covariate_definitions`), with all date expressions such as
+# "first_day_of_month(index_date) - 11 months" resolved by cohortextractor for
+# each index date.
+#
+# Source tables (feather files in --source-dir):
+# - patients.feather: patient_id, sex, date_of_birth, date_of_death
+# - registrations.feather: patient_id, practice, region, start_date, end_date
+# - addresses.feather: patient_id, imd, start_date, end_date
+# - clinical_events.feather: patient_id, code, date, numeric_value
+#
+# Open registration and address periods have a missing end_date.
+#
+# String columns (age_band, sex, imd_q5, region, ...) are written as
+# dictionary-encoded categoricals whose categories are every value the
+# variable can take, rather than those seen in the month, so the codes are the
+# same in every monthly cohort.
+#
+# With --join-ethnicity, the columns of the ethnicity cohort are attached to
+# each monthly cohort as it is written, as the join_ethnicity action does with
+# cohort-joiner, so the cohorts can go straight to output/indicators/joined.
+#
+# With --sort-by-practice, each cohort is written sorted by practice in record
+# batches that never split a practice, with the practices of each batch in the
+# file's metadata (see feather_io.write_by_practice). The files are still
+# ordinary feather files for every other stage, while practice level
+# drill-downs read only the batches of the practices they ask for.
+#
+# With --profile, the time taken, the source rows scanned and the number of
+# patients with a value and of distinct values of every variable are written
+# next to each cohort (input_<study>_<date>.profile.csv), and summarised
+# across months, slowest variable first, in extract_monthly_profile.csv.
+#
+# Usage:
+# python analysis/extract_monthly.py \
+#   --study-definition study_definition_hyp003 \
+#   --index-date-range "2019-03-01 to 2023-03-31 by month" \
+#   --source-dir output/source \
+#   --output-dir output/indicators
+
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from date_utils import (
+    COLUMN_DATE_RE,
+    MISSING_DATE,
+    OPEN_END_DATE,
+    date_to_days,
+    days_to_datetime,
+    generate_date_range,
+    shift_days,
+    to_days,
+)
+from event_index import EventIndex
+from feather_io import read_feather, write_by_practice
+from rule_engine import RuleProgram, column_names, rule_categories
+
+# Version of the extraction, recorded in the fingerprint of every cohort. Bump
+# it whenever a change to this script alters the cohorts it writes (e.g. how a
+# query is evaluated or how columns are encoded), so that --incremental
+# extracts every cohort again rather than keeping ones written by the old code.
+ENGINE_VERSION = 1
+
+SOURCE_TABLES = {
+    "patients": ["patient_id", "sex", "date_of_birth", "date_of_death"],
+    "registrations": ["patient_id", "practice", "region", "start_date", "end_date"],
+    "addresses": ["patient_id", "imd", "start_date", "end_date"],
+    "clinical_events": ["patient_id", "code", "date", "numeric_value"],
+}
+
+
+def load_source(source_dir):
+    tables = {}
+    for name, columns in SOURCE_TABLES.items():
+        tables[name] = pd.read_feather(
+            os.path.join(source_dir, f"{name}.feather"), columns=columns
+        )
+    return Source(tables)
+
+
+class Source:
+    # In-memory source tables, indexed by patient position (the row of the
+    # patient in the sorted patients table)
+    def __init__(self, tables):
+        patients = tables["patients"].sort_values("patient_id")
+        self.patient_id = patients["patient_id"].to_numpy()
+        self.size = len(self.patient_id)
+        self.sex = patients["sex"].fillna("").astype(str).to_numpy(object)
+        self.date_of_birth = to_days(patients["date_of_birth"])
+        self.date_of_death = to_days(patients["date_of_death"])
+        self.registrations = self._load_periods(
+            tables["registrations"], ["practice", "region"]
+        )
+        self.addresses = self._load_periods(tables["addresses"], ["imd"])
+        self._load_events(tables["clinical_events"])
+        self._codelist_events = {}
+
+    def _patient_positions(self, table):
+        positions = np.searchsorted(self.patient_id, table["patient_id"].to_numpy())
+        positions = np.minimum(positions, self.size - 1)
+        known = self.patient_id[positions] == table["patient_id"].to_numpy()
+        return positions, known
+
+    def _load_periods(self, table, value_columns):
+        positions, known = self._patient_positions(table)
+        periods = {
+            "patient": positions[known],
+            "start": to_days(table["start_date"])[known],
+            "end": to_days(table["end_date"])[known],
+        }
+        periods["end"][periods["end"] == MISSING_DATE] = OPEN_END_DATE
+        for column in value_columns:
+            values = table[column]
+            if values.dtype == object:
+                values = values.fillna("")
+            periods[column] = values.to_numpy()[known]
+        # Sort so that the last active period for a patient is the one with
+        # the most recent start date (and then the latest end date)
+        order = np.lexsort((periods["end"], periods["start"], periods["patient"]))
+        return {name: values[order] for name, values in periods.items()}
+
+    def _load_events(self, events):
+        positions, known = self._patient_positions(events)
+        patient = positions[known]
+        date = to_days(events["date"])[known]
+        order = np.lexsort((date, patient))
+        code = pd.Categorical(events["code"].astype(str).to_numpy()[known][order])
+        self.event_patient = patient[order]
+        self.event_date = date[order]
+        self.event_value = events["numeric_value"].to_numpy(dtype=float)[known][order]
+        self.event_code = code.codes
+        self.event_code_index = code.categories
+
+    def events_for(self, codelist):
+        # Index of the events matching a codelist, built once and reused for
+        # every variable and index date using the same codelist
+        key = tuple(codelist)
+        if key not in self._codelist_events:
+            if codelist and isinstance(codelist[0], tuple):
+                codes = [str(code) for code, _ in codelist]
+                categories = np.array([str(c) for _, c in codelist], dtype=object)
+            else:
+                codes = [str(code) for code in codelist]
+                categories = None
+            code_positions = self.event_code_index.get_indexer(codes)
+            matched = code_positions >= 0
+            mask = np.isin(self.event_code, code_positions[matched])
+            columns = {"value": self.event_value[mask]}
+            if categories is not None:
+                lookup = np.full(len(self.event_code_index), "", dtype=object)
+                lookup[code_positions[matched]] = categories[matched]
+                columns["category"] = lookup[self.event_code[mask]]
+            self._codelist_events[key] = EventIndex(
+                self.event_patient[mask], self.event_date[mask], self.size, **columns
+            )
+        return self._codelist_events[key]
+
+
+def last_per_patient(patients):
+    # Positions of the last row for each patient in a patient-sorted array
+    if len(patients) == 0:
+        return np.array([], dtype=np.int64)
+    return np.flatnonzero(np.r_[patients[1:] != patients[:-1], True])
+
+
+def dependencies(query_type, query_args, names):
+    # Variables (among `names`) that a variable definition refers to
+    if query_type == "categorised_as":
+        referenced = set()
+        for expression in query_args["category_definitions"].values():
+            referenced.update(column_names(expression))
+        return referenced & set(names)
+    if query_type == "value_from":
+        return {query_args["source"]}
+    bounds = []
+    for arg in ("between", "start_date", "end_date", "date", "reference_date"):
+        value = query_args.get(arg)
+        bounds.extend(value if isinstance(value, (list, tuple)) else [value])
+    return {
+        match.group("column")
+        for match in map(COLUMN_DATE_RE.match, filter(None, bounds))
+        if match and match.group("column") in names
+    }
+
+
+def required_variables(covariate_definitions, roots):
+    # The given variables and every variable they depend on, directly or not
+    required = set(roots)
+    for name in reversed(list(covariate_definitions)):
+        if name in required:
+            query_type, query_args = covariate_definitions[name]
+            required |= dependencies(query_type, query_args, covariate_definitions)
+    return required
+
+
+def measure_columns(measures):
+    # Columns used by the measures of a study definition
+    columns = set()
+    for measure in measures:
+        columns.update([measure.numerator, measure.denominator, *measure.group_by])
+    return columns
+
+
+class CohortEngine:
+    # Evaluates the covariate definitions of a study definition for a single
+    # index date against the in-memory source tables
+    def __init__(self, source, profile=False):
+        self.source = source
+        self.profile = [] if profile else None
+
+    def reset_shared(self):
+        # Columns shared between study definitions are only valid for the
+        # index date they were evaluated for
+        self.shared = {}
+        self.shared_hits = 0
+
+    def evaluate(self, covariate_definitions, program=None):
+        if program is None:
+            program = RuleProgram(covariate_definitions)
+        self.columns = {}
+        self.dates = {}
+        self.keys = {}
+        self.rules = program.evaluator(self.columns)
+        if self.profile is not None:
+            self.profile = []
+        for name, (query_type, query_args) in covariate_definitions.items():
+            query_args = dict(query_args)
+            query_args.pop("return_expectations", None)
+            query_args.pop("hidden", None)
+            key = self._definition_key(name, query_type, query_args)
+            self.keys[name] = key
+            column_type = query_args.pop("column_type", None)
+            if key in self.shared:
+                self.columns[name], self.dates[name] = self.shared[key]
+                self.shared_hits += 1
+                self._record(name, query_type, query_args, 0.0, shared=True)
+                continue
+            method = getattr(self, f"patients_{query_type}", None)
+            if method is None:
+                raise ValueError(f"Unsupported variable type '{query_type}' ({name})")
+            start = time.perf_counter()
+            self.columns[name] = method(
+                name=name, column_type=column_type, **query_args
+            )
+            seconds = time.perf_counter() - start
+            self._record(name, query_type, query_args, seconds)
+            self.shared[key] = (self.columns[name], self.dates.get(name))
+        return self.columns
+
+    def _record(self, name, query_type, query_args, seconds, shared=False):
+        # Profile of a variable: the time it took, the rows of the source it
+        # works over (the events of its codelist, the registration or address
+        # periods, or one row per patient) and how many patients have a value
+        # and how many distinct values there are. A rule's time includes the
+        # sub-expressions it is the first to use.
+        if self.profile is None:
+            return
+        values = self.columns[name]
+        if "codelist" in query_args:
+            scanned = len(self.source.events_for(query_args["codelist"]))
+        elif query_type.startswith("registered_"):
+            scanned = len(self.source.registrations["patient"])
+        elif query_type == "address_as_of":
+            scanned = len(self.source.addresses["patient"])
+        else:
+            scanned = self.source.size
+        if values.dtype == object:
+            with_value = int(np.count_nonzero(values != ""))
+        elif query_args.get("returning") == "date":
+            with_value = int(np.count_nonzero(values != MISSING_DATE))
+        else:
+            with_value = int(np.count_nonzero(values))
+        self.profile.append(
+            {
+                "variable": name,
+                "query_type": query_type,
+                "seconds": seconds,
+                "shared": shared,
+                "rows_scanned": scanned,
+                "patients_with_value": with_value,
+                "distinct_values": len(pd.unique(values)),
+            }
+        )
+
+    def _definition_key(self, name, query_type, query_args):
+        # Identifies a column by its resolved definition and the definitions
+        # of the columns it depends on, so that the same variable spread into
+        # several study definitions (e.g. `hyp_reg` or `age`) is evaluated
+        # once per index date
+        parts = [name, query_type]
+        for arg, value in sorted(query_args.items()):
+            if arg == "codelist":
+                value = tuple(value)
+            parts.append((arg, value))
+        for dependency in sorted(dependencies(query_type, query_args, self.columns)):
+            parts.append(self.keys[dependency])
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    # Date bounds
+
+    def _date_bound(self, bound, default):
+        # Resolve a date bound into a scalar or a per-patient array of days
+        if bound is None:
+            return default
+        match = COLUMN_DATE_RE.match(bound)
+        if match and match.group("column") in self.columns:
+            days = self.columns[match.group("column")]
+            if match.group("op"):
+                days = shift_days(
+                    days, match.group("op"), int(match.group("n")), match.group("unit")
+                )
+            return days
+        return date_to_days(bound)
+
+    def _window(self, between):
+        start, end = between if between else (None, None)
+        start = self._date_bound(start, MISSING_DATE + 1)
+        end = self._date_bound(end, OPEN_END_DATE)
+        if isinstance(start, np.ndarray):
+            # Patients with a missing date bound have no matching events
+            start = np.where(start == MISSING_DATE, OPEN_END_DATE, start)
+        return start, end
+
+    # Demographics and registration
+
+    def patients_all(self, **kwargs):
+        return np.ones(self.source.size, dtype=bool)
+
+    def patients_sex(self, **kwargs):
+        return self.source.sex
+
+    def patients_age_as_of(self, reference_date, **kwargs):
+        reference = pd.Timestamp(reference_date)
+        born = pd.DatetimeIndex(self.source.date_of_birth.astype("datetime64[D]"))
+        birthday_to_come = (born.month > reference.month) | (
+            (born.month == reference.month) & (born.day > reference.day)
+        )
+        age = reference.year - born.year - birthday_to_come
+        return np.nan_to_num(np.asarray(age, dtype=float)).astype(np.int64)
+
+    def patients_died_from_any_cause(self, between, returning, **kwargs):
+        if returning != "binary_flag":
+            raise ValueError(f"Unsupported returning value '{returning}' for died")
+        death = self.source.date_of_death
+        start = self._date_bound(between[0], MISSING_DATE + 1)
+        end = self._date_bound(between[1], OPEN_END_DATE)
+        return (death != MISSING_DATE) & (death >= start) & (death <= end)
+
+    def _registered_between(self, start_date, end_date):
+        periods = self.source.registrations
+        start = date_to_days(start_date)
+        end = date_to_days(end_date)
+        covering = (periods["start"] <= start) & (periods["end"] > end)
+        registered = np.zeros(self.source.size, dtype=bool)
+        registered[periods["patient"][covering]] = True
+        return registered
+
+    def patients_registered_as_of(self, reference_date, **kwargs):
+        return self._registered_between(reference_date, reference_date)
+
+    def patients_registered_with_one_practice_between(
+        self, start_date, end_date, **kwargs
+    ):
+        return self._registered_between(start_date, end_date)
+
+    def _latest_active(self, periods, date):
+        # Rows of the most recent period active on the date for each patient
+        day = date_to_days(date)
+        active = np.flatnonzero((periods["start"] <= day) & (periods["end"] > day))
+        return active[last_per_patient(periods["patient"][active])]
+
+    def patients_registered_practice_as_of(self, date, returning, **kwargs):
+        periods = self.source.registrations
+        rows = self._latest_active(periods, date)
+        if returning == "pseudo_id":
+            values = np.zeros(self.source.size, dtype=np.int64)
+            values[periods["patient"][rows]] = periods["practice"][rows]
+        elif returning == "nuts1_region_name":
+            values = np.full(self.source.size, "", dtype=object)
+            values[periods["patient"][rows]] = periods["region"][rows]
+        else:
+            raise ValueError(f"Unsupported returning value '{returning}' for practice")
+        return values
+
+    def patients_address_as_of(self, date, returning, round_to_nearest=None, **kwargs):
+        if returning != "index_of_multiple_deprivation":
+            raise ValueError(f"Unsupported returning value '{returning}' for address")
+        periods = self.source.addresses
+        rows = self._latest_active(periods, date)
+        imd = periods["imd"][rows].astype(float)
+        if round_to_nearest:
+            imd = np.round(imd / round_to_nearest) * round_to_nearest
+        values = np.full(self.source.size, -1, dtype=np.int64)
+        values[periods["patient"][rows]] = np.where(np.isnan(imd), -1, imd)
+        return values
+
+    # Clinical events
+
+    def patients_with_these_clinical_events(
+        self,
+        name,
+        codelist,
+        returning,
+        between=None,
+        find_first_match_in_period=None,
+        find_last_match_in_period=None,
+        include_date_of_match=False,
+        episode_defined_as=None,
+        ignore_days_where_these_codes_occur=None,
+        ignore_missing_values=False,
+        **kwargs,
+    ):
+        unsupported = {
+            "episode_defined_as": episode_defined_as,
+            "ignore_days_where_these_codes_occur": ignore_days_where_these_codes_occur,
+            "ignore_missing_values": ignore_missing_values,
+        }
+        for arg, value in unsupported.items():
+            if value:
+                raise ValueError(
+                    f"Unsupported argument '{arg}' for clinical events ({name})"
+                )
+        events = self.source.events_for(codelist)
+        start, end = self._window(between)
+        if find_first_match_in_period:
+            rows = events.first(start, end, cursor=name)
+        else:
+            rows = events.last(start, end, cursor=name)
+        if returning == "binary_flag":
+            values = rows >= 0
+        elif returning == "date":
+            values = events.values_at("date", rows, MISSING_DATE)
+        elif returning == "category":
+            values = events.values_at("category", rows, "")
+        elif returning == "number_of_matches_in_period":
+            values = events.count(start, end, cursor=name).astype(np.int64)
+        else:
+            raise ValueError(
+                f"Unsupported returning value '{returning}' for clinical events"
+            )
+        self.dates[name] = events.values_at("date", rows, MISSING_DATE)
+        return values
+
+    def patients_mean_recorded_value(
+        self, name, codelist, on_most_recent_day_of_measurement, between, **kwargs
+    ):
+        events = self.source.events_for(codelist)
+        start, end = self._window(between)
+        lo, hi = events.window(start, end, cursor=name)
+        last_date = events.values_at(
+            "date", np.where(hi > lo, hi - 1, -1), MISSING_DATE
+        )
+        if on_most_recent_day_of_measurement:
+            # Only the events on the day of the last event in the period
+            lo = np.where(hi > lo, events.window(last_date, last_date)[0], lo)
+        patients, rows = events.rows(lo, hi)
+        size = self.source.size
+        # Events without a value are left out of the mean, as by SQL AVG
+        recorded = events.columns["value"][rows]
+        valued = ~np.isnan(recorded)
+        patients = patients[valued]
+        total = np.bincount(patients, weights=recorded[valued], minlength=size)
+        count = np.bincount(patients, minlength=size)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            values = np.where(count > 0, total / np.maximum(count, 1), 0.0)
+        self.dates[name] = last_date
+        return values
+
+    def patients_value_from(self, source, returning, **kwargs):
+        if returning != "date":
+            raise ValueError(f"Unsupported returning value '{returning}' for {source}")
+        return self.dates[source]
+
+    # Expressions
+
+    def patients_categorised_as(self, name, **kwargs):
+        # Rules are compiled once per study definition, and sub-expressions
+        # shared between rules are evaluated once per index date
+        return self.rules.column(name)
+
+
+def code_table(source, query_type, query_args):
+    # All the values a string column can take, in sorted order, or None when
+    # they aren't known before extracting. Categorical columns are written
+    # with these categories, so a value has the same code in every month.
+    if query_type == "categorised_as":
+        return rule_categories(query_args)
+    if query_type == "sex":
+        categories = source.sex
+    elif query_type == "registered_practice_as_of":
+        categories = source.registrations["region"]
+    elif query_type == "with_these_clinical_events":
+        categories = [category for _, category in query_args["codelist"]]
+    else:
+        return None
+    return sorted(set(categories) - {""})
+
+
+def code_tables(source, covariate_definitions):
+    tables = {}
+    for name, (query_type, query_args) in covariate_definitions.items():
+        if query_args.get("column_type") == "str":
+            tables[name] = code_table(source, query_type, query_args)
+    return tables
+
+
+def to_dataframe(source, columns, covariate_definitions, outputs=None, tables=None):
+    # Build the cohort for the population in the same layout as cohortextractor:
+    # patient_id followed by every column that isn't hidden (or, if given,
+    # every column in `outputs`)
+    tables = tables or {}
+    population = columns["population"]
+    data = {"patient_id": source.patient_id[population]}
+    for name, (query_type, query_args) in covariate_definitions.items():
+        if name == "population" or query_args.get("hidden"):
+            continue
+        if outputs is not None and name not in outputs:
+            continue
+        values = columns[name][population]
+        column_type = query_args.get("column_type")
+        if column_type == "date":
+            data[name] = days_to_datetime(values)
+        elif column_type == "str":
+            data[name] = pd.Categorical(
+                pd.Series(values).replace("", None), categories=tables.get(name)
+            )
+        else:
+            data[name] = values
+    return pd.DataFrame(data)
+
+
+def load_lookup(path):
+    # Cohort joined onto every monthly cohort, e.g. input_ethnicity.feather,
+    # indexed by patient_id. The index is a hash table, so joining it is one
+    # lookup per patient rather than a merge.
+    return read_feather(path).set_index("patient_id")
+
+
+def join_lookup(df, lookup):
+    # Left join on patient_id, with the lookup columns after the cohort's own;
+    # patients missing from the lookup get missing values
+    values = lookup.reindex(df["patient_id"].to_numpy())
+    values.index = df.index
+    return pd.concat([df, values], axis=1)
+
+
+def load_study(study_name):
+    return importlib.import_module(study_name).study
+
+
+def load_measures(study_name):
+    return getattr(importlib.import_module(study_name), "measures", [])
+
+
+def output_path(output_dir, study_name, index_date):
+    suffix = study_name.replace("study_definition", "")
+    return os.path.join(output_dir, f"input{suffix}_{index_date}.feather")
+
+
+def profile_path(cohort_path):
+    # Profile of the variables of a cohort, written next to it
+    return cohort_path.replace(".feather", ".profile.csv")
+
+
+def write_profile(path, study_name, index_date, profile):
+    df = pd.DataFrame(profile)
+    df.insert(0, "index_date", index_date)
+    df.insert(0, "study", study_name)
+    df.to_csv(f"{path}.tmp", index=False)
+    os.replace(f"{path}.tmp", path)
+
+
+def summarise_profiles(output_dir, study_names, index_dates):
+    # Profile of each variable across months, slowest first, from the
+    # profiles of the cohorts in the output directory
+    paths = [
+        profile_path(output_path(output_dir, study_name, index_date))
+        for study_name in study_names
+        for index_date in index_dates
+    ]
+    paths = [path for path in paths if os.path.exists(path)]
+    if not paths:
+        return None
+    df = pd.concat([pd.read_csv(path) for path in paths], ignore_index=True)
+    summary = df.groupby(["study", "variable", "query_type"], as_index=False).agg(
+        months=("index_date", "nunique"),
+        total_seconds=("seconds", "sum"),
+        mean_seconds=("seconds", "mean"),
+        max_seconds=("seconds", "max"),
+        shared_months=("shared", "sum"),
+        mean_rows_scanned=("rows_scanned", "mean"),
+        mean_patients_with_value=("patients_with_value", "mean"),
+        mean_distinct_values=("distinct_values", "mean"),
+    )
+    summary["share_of_time"] = summary["total_seconds"] / df["seconds"].sum()
+    summary = summary.sort_values("total_seconds", ascending=False)
+    path = os.path.join(output_dir, "extract_monthly_profile.csv")
+    summary.to_csv(path, index=False)
+    return path
+
+
+def fingerprint(covariate_definitions, outputs=None, joined=(), by_practice=False):
+    # Identifies the variable definitions of a study for one index date, with
+    # every date, codelist and rule resolved. Any change to the study
+    # definition, its codelists or the config that alters the extracted
+    # cohort changes the fingerprint, while expectations (which only affect
+    # dummy data) are ignored, as are changes to this script unless they bump
+    # ENGINE_VERSION.
+    parts = [("engine", ENGINE_VERSION)]
+    for name, (query_type, query_args) in covariate_definitions.items():
+        args = []
+        for arg, value in sorted(query_args.items()):
+            if arg == "return_expectations":
+                continue
+            if arg == "codelist":
+                value = tuple(value)
+            args.append((arg, value))
+        parts.append((name, query_type, args))
+    if outputs is not None:
+        parts.append(sorted(outputs))
+    if joined:
+        parts.append(("joined", list(joined)))
+    if by_practice:
+        parts.append("by_practice")
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+def manifest_path(output_dir):
+    return os.path.join(output_dir, "extract_monthly_manifest.json")
+
+
+def load_manifest(output_dir):
+    # Fingerprints of the cohorts previously written to the output directory
+    path = manifest_path(output_dir)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(output_dir, manifest):
+    path = manifest_path(output_dir)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+
+class MonthlyExtractor:
+    # Extracts the cohorts of one or more study definitions for an index date,
+    # keeping the study definitions and their compiled rules between dates
+    def __init__(
+        self,
+        study_names,
+        source,
+        output_dir,
+        compression="zstd",
+        prune=False,
+        lookup=None,
+        by_practice=False,
+        profile=False,
+    ):
+        self.studies = {name: load_study(name) for name in study_names}
+        self.outputs = {}
+        if prune:
+            # Only the columns used by the measures are written, and only the
+            # variables they (or the population) depend on are evaluated
+            for name in study_names:
+                self.outputs[name] = measure_columns(load_measures(name))
+        self.programs = {}
+        self.tables = {}
+        self.source = source
+        self.engine = CohortEngine(source, profile)
+        self.output_dir = output_dir
+        self.compression = compression
+        self.prune = prune
+        self.lookup = lookup
+        self.by_practice = by_practice
+        self.profile = profile
+
+    def definitions(self, study_name, index_date):
+        # Variable definitions of a study for the index date, and the columns
+        # to write (None for all of them)
+        study = self.studies[study_name]
+        study.set_index_date(index_date)
+        covariate_definitions = study.covariate_definitions
+        outputs = self.outputs.get(study_name)
+        if outputs is not None:
+            required = required_variables(
+                covariate_definitions, {"population", *outputs}
+            )
+            covariate_definitions = {
+                name: definition
+                for name, definition in covariate_definitions.items()
+                if name in required
+            }
+        return covariate_definitions, outputs
+
+    def joined_columns(self, outputs):
+        # Columns of the lookup joined onto a cohort: all of them, or only
+        # those used by the measures when columns are pruned
+        if self.lookup is None:
+            return []
+        return [name for name in self.lookup if outputs is None or name in outputs]
+
+    def sorted_by_practice(self, covariate_definitions, outputs):
+        # Cohorts can only be sorted by practice if they have the column
+        return (
+            self.by_practice
+            and "practice" in covariate_definitions
+            and (outputs is None or "practice" in outputs)
+        )
+
+    def fingerprints(self, index_date):
+        fingerprints = {}
+        for study_name in self.studies:
+            covariate_definitions, outputs = self.definitions(study_name, index_date)
+            fingerprints[study_name] = fingerprint(
+                covariate_definitions,
+                outputs,
+                self.joined_columns(outputs),
+                self.sorted_by_practice(covariate_definitions, outputs),
+            )
+        return fingerprints
+
+    def extract(self, index_date, study_names):
+        # Study definitions extracted together share every column with an
+        # identical definition, so the hypertension register and demographics
+        # are computed once per index date rather than once per indicator
+        self.engine.reset_shared()
+        written = []
+        for study_name in study_names:
+            covariate_definitions, outputs = self.definitions(study_name, index_date)
+            if study_name not in self.programs:
+                self.programs[study_name] = RuleProgram(covariate_definitions)
+                self.tables[study_name] = code_tables(
+                    self.source, covariate_definitions
+                )
+            program = self.programs[study_name]
+            columns = self.engine.evaluate(covariate_definitions, program)
+            df = to_dataframe(
+                self.source,
+                columns,
+                covariate_definitions,
+                outputs,
+                self.tables[study_name],
+            )
+            joined = self.joined_columns(outputs)
+            if joined:
+                df = join_lookup(df, self.lookup[joined])
+            path = output_path(self.output_dir, study_name, index_date)
+            by_practice = self.sorted_by_practice(covariate_definitions, outputs)
+            # Written under a temporary name so that a failed or interrupted
+            # extraction never leaves a partial cohort behind
+            if by_practice:
+                write_by_practice(df, f"{path}.tmp", self.compression)
+            else:
+                df.to_feather(f"{path}.tmp", compression=self.compression)
+            os.replace(f"{path}.tmp", path)
+            if self.profile:
+                write_profile(
+                    profile_path(path), study_name, index_date, self.engine.profile
+                )
+            written.append(
+                (
+                    path,
+                    fingerprint(covariate_definitions, outputs, joined, by_practice),
+                )
+            )
+        return written, self.engine.shared_hits
+
+
+# Each worker process keeps its own extractor; with the default "fork" start
+# method on Linux the source tables are inherited rather than copied
+_worker_extractor = None
+
+
+def _init_worker(
+    study_names, source, output_dir, compression, prune, lookup, by_practice, profile
+):
+    global _worker_extractor
+    _worker_extractor = MonthlyExtractor(
+        study_names,
+        source,
+        output_dir,
+        compression,
+        prune,
+        lookup,
+        by_practice,
+        profile,
+    )
+
+
+def _extract_in_worker(index_date, study_names):
+    return _worker_extractor.extract(index_date, study_names)
+
+
+def extract_monthly(
+    study_names,
+    index_dates,
+    source,
+    output_dir,
+    incremental=False,
+    workers=1,
+    retries=0,
+    compression="zstd",
+    prune=False,
+    lookup=None,
+    by_practice=False,
+    profile=False,
+):
+    # Index dates are independent of each other, so with more than one worker
+    # they are extracted in parallel, each by a pool process. An index date
+    # that fails is retried up to `retries` times (in a new pool, in case a
+    # worker was killed) before the extraction is abandoned.
+    #
+    # In incremental mode only cohorts that are missing, or whose fingerprint
+    # differs from the one recorded when they were written, are extracted.
+    extractor = MonthlyExtractor(
+        study_names,
+        source,
+        output_dir,
+        compression,
+        prune,
+        lookup,
+        by_practice,
+        profile,
+    )
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_manifest(output_dir)
+    pending = {}
+    skipped = 0
+    for index_date in index_dates:
+        for study_name, current in extractor.fingerprints(index_date).items():
+            path = output_path(output_dir, study_name, index_date)
+            key = os.path.basename(path)
+            if incremental and os.path.exists(path) and manifest.get(key) == current:
+                skipped += 1
+                continue
+            pending.setdefault(index_date, []).append(study_name)
+
+    paths = []
+    shared = 0
+    attempts = dict.fromkeys(pending, 0)
+    while pending:
+        failed = {}
+        for index_date, result in _run_extractions(
+            extractor, pending, workers, study_names
+        ):
+            if isinstance(result, Exception):
+                attempts[index_date] += 1
+                if attempts[index_date] > retries:
+                    raise RuntimeError(
+                        f"Extraction failed for {index_date}"
+                    ) from result
+                print(f"Retrying {index_date} after error: {result!r}")
+                failed[index_date] = pending[index_date]
+                continue
+            written, hits = result
+            shared += hits
+            # Recorded as each index date is written, so an interrupted run
+            # resumes from the cohorts it did not write
+            for path, current in written:
+                manifest[os.path.basename(path)] = current
+                paths.append(path)
+            save_manifest(output_dir, manifest)
+        pending = failed
+    return sorted(paths), shared, skipped
+
+
+def _run_extractions(extractor, pending, workers, study_names):
+    # Yield (index_date, result or exception) as extractions complete
+    if workers <= 1:
+        for index_date, names in pending.items():
+            try:
+                yield index_date, extractor.extract(index_date, names)
+            except Exception as e:
+                yield index_date, e
+        return
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(pending)),
+        initializer=_init_worker,
+        initargs=(
+            study_names,
+            extractor.source,
+            extractor.output_dir,
+            extractor.compression,
+            extractor.prune,
+            extractor.lookup,
+            extractor.by_practice,
+            extractor.profile,
+        ),
+    ) as pool:
+        futures = {
+            pool.submit(_extract_in_worker, index_date, names): index_date
+            for index_date, names in pending.items()
+        }
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except Exception as e:
+                yield futures[future], e
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Extract all monthly cohorts of one or more studies in a single pass"
+    )
+    parser.add_argument(
+        "--study-definition",
+        required=True,
+        nargs="+",
+        help="One or more study definitions, extracted together",
+    )
+    parser.add_argument("--index-date-range", required=True)
+    parser.add_argument("--source-dir", required=True)
+    parser.add_argument("--output-dir", default="output/indicators")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only extract cohorts that are missing or out of date",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of index dates extracted in parallel",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=0,
+        help="Number of times an index date is retried after a failure",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=["zstd", "lz4", "uncompressed"],
+        default="zstd",
+        help="Compression of the cohorts; uncompressed cohorts can be "
+        "memory-mapped by later stages without decompressing",
+    )
+    parser.add_argument(
+        "--prune-columns",
+        action="store_true",
+        help="Only write the columns used by the measures of each study",
+    )
+    parser.add_argument(
+        "--join-ethnicity",
+        metavar="PATH",
+        help="Ethnicity cohort (input_ethnicity.feather) to join onto each "
+        "monthly cohort as it is written",
+    )
+    parser.add_argument(
+        "--sort-by-practice",
+        action="store_true",
+        help="Write the cohorts sorted by practice, with an index of the "
+        "practices in each record batch, for practice level reads",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Record the time, rows scanned and number of values of each "
+        "variable next to each cohort, and summarise them across months",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    source = load_source(args.source_dir)
+    index_dates = generate_date_range(args.index_date_range)
+    lookup = load_lookup(args.join_ethnicity) if args.join_ethnicity else None
+    paths, shared, skipped = extract_monthly(
+        args.study_definition,
+        index_dates,
+        source,
+        args.output_dir,
+        incremental=args.incremental,
+        workers=args.workers,
+        retries=args.retries,
+        compression=args.compression,
+        prune=args.prune_columns,
+        lookup=lookup,
+        by_practice=args.sort_by_practice,
+        profile=args.profile,
+    )
+    print(f"Extracted {len(paths)} monthly cohorts to {args.output_dir}")
+    if args.profile:
+        path = summarise_profiles(args.output_dir, args.study_definition, index_dates)
+        print(f"Wrote the profile of every variable across months to {path}")
+    if args.incremental:
+        print(f"Skipped {skipped} cohorts that are up to date")
+    print(f"Reused {shared} columns shared between study definitions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# Column-selective reading of feather cohorts
+#
+# The monthly cohorts are wide (every variable of a study definition), while
+# each stage only needs a few columns, e.g. a numerator, a denominator and
+# one breakdown for a measure. The files are memory-mapped and only the
+# requested columns are read, so memory use is bounded by the working
+# columns rather than the full width of the cohort. For uncompressed files,
+# numeric columns without missing values are used in place, without copying.
+
+import bisect
+import json
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+
+
+def cohort_columns(path):
+    # Column names of a feather file, from its schema only
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).schema.names
+
+
+def read_table(path, columns=None):
+    # Arrow table of the given columns (or all of them) of a feather file
+    return feather.read_table(path, columns=columns, memory_map=True)
+
+
+def read_feather(path, columns=None):
+    # Data frame of the given columns (or all of them) of a feather file. Each
+    # column gets its own block, which lets pandas use the memory-mapped
+    # buffers directly where the types allow it.
+    table = read_table(path, columns=columns)
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+# Cohorts sorted by practice are written as one record batch per run of
+# practices, with the first and last practice of each batch recorded in the
+# schema metadata, so the patients of a few practices can be read without
+# scanning the whole cohort
+PRACTICE_INDEX_KEY = b"practice_index"
+PRACTICE_BATCH_ROWS = 65_536
+
+
+def write_by_practice(df, path, compression="zstd", batch_rows=PRACTICE_BATCH_ROWS):
+    # Feather file of a cohort sorted by practice; every practice is in a
+    # single batch, so batches hold about `batch_rows` rows
+    order = np.argsort(df["practice"].to_numpy(), kind="stable")
+    df = df.iloc[order].reset_index(drop=True)
+    practices = df["practice"].to_numpy()
+    starts = [0]
+    while starts[-1] + batch_rows < len(df):
+        target = practices[starts[-1] + batch_rows]
+        starts.append(int(np.searchsorted(practices, target, side="left")))
+        if starts[-1] == starts[-2]:
+            # A single practice larger than a batch
+            starts[-1] = int(np.searchsorted(practices, target, side="right"))
+    bounds = list(zip(starts, starts[1:] + [len(df)]))
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    index = [
+        [int(practices[start]), int(practices[end - 1])]
+        for start, end in bounds
+        if end > start
+    ]
+    metadata = dict(table.schema.metadata or {})
+    metadata[PRACTICE_INDEX_KEY] = json.dumps(index).encode()
+    schema = table.schema.with_metadata(metadata)
+    options = pa.ipc.IpcWriteOptions(
+        compression=None if compression == "uncompressed" else compression
+    )
+    with pa.OSFile(path, "wb") as sink:
+        with pa.ipc.new_file(sink, schema, options=options) as writer:
+            for start, end in bounds:
+                if end > start:
+                    batch = table.slice(start, end - start).combine_chunks()
+                    writer.write_table(batch, max_chunksize=end - start)
+
+
+def read_practices(path, practices, columns=None):
+    # Data frame of the patients of the given practices, reading only the
+    # batches that can hold them when the cohort has a practice index
+    practices = sorted(set(int(practice) for practice in practices))
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        metadata = reader.schema.metadata or {}
+        if PRACTICE_INDEX_KEY in metadata:
+            index = json.loads(metadata[PRACTICE_INDEX_KEY])
+            wanted = [
+                i
+                for i, (first, last) in enumerate(index)
+                if bisect.bisect_left(practices, first)
+                < bisect.bisect_right(practices, last)
+            ]
+            batches = [reader.get_batch(i) for i in wanted]
+            table = pa.Table.from_batches(batches, schema=reader.schema)
+        else:
+            table = reader.read_all()
+    if columns is not None:
+        table = table.select(list(dict.fromkeys([*columns, "practice"])))
+    value_set = pa.array(practices, table.schema.field("practice").type)
+    table = table.filter(pc.is_in(table["practice"], value_set=value_set))
+    if columns is not None and "practice" not in columns:
+        table = table.drop(["practice"])
+    return table.to_pandas(split_blocks=True, self_destruct=True)
@@ -0,0 +1,245 @@
+# Batched calculation of all measures of a study definition
+#
+# `cohortextractor generate_measures` calculates each `Measure` on its own and
+# writes a CSV per measure and month: over 30 measures for HYP003, most of
+# them grouped by "population" or a single demographic breakdown. This script
+# reads each monthly cohort once per distinct `group_by` (only the columns
+# needed, see feather_io.py) and calculates every measure sharing it from a
+# single grouped sum over all of their numerators and denominators. Small
+# number suppression is then applied per measure exactly as cohortextractor
+# does (see disclosure.py).
+#
+# With --release, the rows are also written with their counts rounded to the
+# nearest 10 and the value recalculated from the rounded counts, as
+# join_measures.py does, to measures_release<suffix>.csv. Suppression and
+# rounding are applied to each month's results as they are calculated, so the
+# release file is ready in the same pass.
+#
+# All measures of a study are written to a single long-format file with the
+# columns measure_id, date, group, category, numerator, denominator and value.
+# For measures grouped by "population", group and category are "population".
+#
+# With --dataset-dir, the same rows are also written to a parquet dataset
+# partitioned by indicator (<dataset-dir>/indicator=<indicator>/part-0.parquet,
+# with one row group per month), so that consumers can read a subset of
+# indicators, measures or months with filters pushed down to the files rather
+# than reading every CSV:
+#
+#   pyarrow.dataset.dataset(dataset_dir, partitioning="hive").to_table(
+#       filter=(ds.field("indicator") == "hyp003")
+#       & (ds.field("measure_id") == "hyp003_achievem_population_rate")
+#   )
+#
+# Usage:
+# python analysis/generate_measures.py \
+#   --study-definition study_definition_hyp003 \
+#   --input-dir output/indicators/joined \
+#   --output-dir output/indicators/joined \
+#   --dataset-dir output/indicators/joined/measures_long \
+#   --release
+
+import argparse
+import contextlib
+import importlib
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from disclosure import release, suppress_small_numbers
+from feather_io import read_feather
+
+POPULATION = "population"
+
+COHORT_RE = re.compile(r"^input(?P<suffix>.*)_(?P<date>\d{4}-\d{2}-\d{2})\.feather$")
+
+DATASET_SCHEMA = pa.schema(
+    [
+        ("measure_id", pa.string()),
+        ("date", pa.date32()),
+        ("group", pa.string()),
+        ("category", pa.string()),
+        ("numerator", pa.float64()),
+        ("denominator", pa.float64()),
+        ("value", pa.float64()),
+    ]
+)
+
+LONG_COLUMNS = [
+    "measure_id",
+    "date",
+    "group",
+    "category",
+    "numerator",
+    "denominator",
+    "value",
+]
+
+
+def study_suffix(study_name):
+    return study_name.replace("study_definition", "")
+
+
+def dataset_path(dataset_dir, suffix):
+    indicator = suffix.lstrip("_")
+    return os.path.join(dataset_dir, f"indicator={indicator}", "part-0.parquet")
+
+
+def dataset_table(results):
+    table = results.assign(date=pd.to_datetime(results["date"]).dt.date)
+    return pa.Table.from_pandas(table, schema=DATASET_SCHEMA, preserve_index=False)
+
+
+def cohort_files(input_dir, suffix):
+    # Monthly cohorts of a study, in date order
+    cohorts = []
+    for file in os.listdir(input_dir):
+        match = COHORT_RE.match(file)
+        if match and match.group("suffix") == suffix:
+            cohorts.append((match.group("date"), os.path.join(input_dir, file)))
+    return sorted(cohorts)
+
+
+def measure_batches(measures):
+    # Measures grouped by their `group_by`, with the numeric columns summed
+    # for each group
+    batches = {}
+    for measure in measures:
+        group_by = tuple(measure.group_by)
+        columns = batches.setdefault(group_by, {})
+        columns.setdefault(measure.numerator)
+        columns.setdefault(measure.denominator)
+    return {group_by: list(columns) for group_by, columns in batches.items()}
+
+
+def load_columns(path, group_by, columns):
+    # Read only the given columns of a cohort, with the special "population"
+    # column set to 1 for every patient
+    names = {*group_by, *columns}
+    names.discard(POPULATION)
+    df = read_feather(path, columns=sorted(names))
+    df[POPULATION] = 1
+    return df
+
+
+def group_sums(df, group_by, columns):
+    if group_by == (POPULATION,):
+        return df[columns].sum().to_frame().T
+    return df.groupby(list(group_by), observed=False)[columns].sum().reset_index()
+
+
+def calculate_measures(path, measures, date):
+    # Long-format results of every measure for one monthly cohort. Each batch
+    # reads only its own columns from the memory-mapped cohort, so memory use
+    # is bounded by the widest batch rather than the whole cohort.
+    sums = {}
+    for group_by, columns in measure_batches(measures).items():
+        df = load_columns(path, group_by, columns)
+        sums[group_by] = group_sums(df, group_by, columns)
+    results = []
+    for measure in measures:
+        group_by = tuple(measure.group_by)
+        grouped = sums[group_by]
+        numerator = grouped[measure.numerator].to_numpy(dtype=float)
+        denominator = grouped[measure.denominator].to_numpy(dtype=float)
+        if measure.small_number_suppression:
+            numerator = suppress_small_numbers(numerator)
+            denominator = suppress_small_numbers(denominator)
+        if group_by == (POPULATION,):
+            group = category = POPULATION
+        else:
+            group = ",".join(group_by)
+            category = grouped[list(group_by)].astype(str).agg(",".join, axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            value = numerator / denominator
+        results.append(
+            pd.DataFrame(
+                {
+                    "measure_id": measure.id,
+                    "date": date,
+                    "group": group,
+                    "category": category,
+                    "numerator": numerator,
+                    "denominator": denominator,
+                    "value": value,
+                }
+            )
+        )
+    return pd.concat(results, ignore_index=True)[LONG_COLUMNS]
+
+
+def generate_measures(
+    study_name, input_dir, output_dir, dataset_dir=None, release_file=False
+):
+    measures = importlib.import_module(study_name).measures
+    suffix = study_suffix(study_name)
+    path = os.path.join(output_dir, f"measures_long{suffix}.csv")
+    header = ",".join(LONG_COLUMNS) + "\n"
+    rows = 0
+    with contextlib.ExitStack() as stack:
+        f = stack.enter_context(open(path, "w", newline=""))
+        f.write(header)
+        release_f = None
+        if release_file:
+            release_path = os.path.join(output_dir, f"measures_release{suffix}.csv")
+            release_f = stack.enter_context(open(release_path, "w", newline=""))
+            release_f.write(header)
+        writer = None
+        if dataset_dir:
+            parquet_path = dataset_path(dataset_dir, suffix)
+            os.makedirs(os.path.dirname(parquet_path), exist_ok=True)
+            writer = stack.enter_context(
+                pq.ParquetWriter(parquet_path, DATASET_SCHEMA, compression="zstd")
+            )
+        for date, cohort in cohort_files(input_dir, suffix):
+            results = calculate_measures(cohort, measures, date)
+            results.to_csv(f, header=False, index=False)
+            if writer is not None:
+                writer.write_table(dataset_table(results))
+            if release_f is not None:
+                # Rounded counts are written as whole numbers
+                release(results).astype(
+                    {"numerator": "Int64", "denominator": "Int64"}
+                ).to_csv(release_f, header=False, index=False, na_rep="NA")
+            rows += len(results)
+    return path, rows
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Calculate all measures of a study definition in one pass"
+    )
+    parser.add_argument("--study-definition", required=True, nargs="+")
+    parser.add_argument("--input-dir", default="output/indicators/joined")
+    parser.add_argument("--output-dir", default="output/indicators/joined")
+    parser.add_argument(
+        "--dataset-dir",
+        help="Also write the measures to a parquet dataset partitioned by indicator",
+    )
+    parser.add_argument(
+        "--release",
+        action="store_true",
+        help="Also write the measures with counts rounded to the nearest 10",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    for study_name in args.study_definition:
+        path, rows = generate_measures(
+            study_name,
+            args.input_dir,
+            args.output_dir,
+            args.dataset_dir,
+            args.release,
+        )
+        print(f"Wrote {rows} measure rows to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+# This script joins the measures files of each indicator and rounds counts to
+# the nearest 10, replacing join_measures.R
+#
+# The combined measure files written by `generate_measures_*` (one per
+# measure, with a row per month) are streamed in chunks into a single file per
+# indicator, so memory use does not grow with the number of breakdowns and
+# months. The breakdown column of each grouped measure is pivoted into
+# `group` (the breakdown name) and `category` (its value); the population
+# measure gets "population" for both.
+#
+# Categories and values are written as join_measures.R wrote them, since
+# lib/functions/funs_tidy_data.R relies on them: boolean breakdowns (e.g.
+# care_home) as TRUE/FALSE, and infinite values as Inf/-Inf.
+#
+# For each indicator this writes:
+# - measures_<indicator>.feather: for further processing
+# - measures_<indicator>.csv: for release
+#
+# Usage:
+# python analysis/join_measures.py \
+#   --input-dir output/indicators/joined \
+#   --output-dir output/indicators/joined/measures
+
+import argparse
+import glob
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from disclosure import round_counts
+
+# Breakdown values that readr parses as logical, as join_measures.R read the
+# measure files, and the category it then wrote for them
+LOGICAL_CATEGORIES = {
+    "True": "TRUE",
+    "TRUE": "TRUE",
+    "true": "TRUE",
+    "False": "FALSE",
+    "FALSE": "FALSE",
+    "false": "FALSE",
+}
+
+# Measure id prefix, numerator and denominator of each indicator, and the
+# counts that are rounded before recalculating the value
+INDICATORS = {
+    "hyp001": {
+        "prefix": "hyp001_prevalence",
+        "numerator": "hyp_reg",
+        "denominator": "population",
+        "counts": ["hyp_reg", "population"],
+    },
+    "hyp003": {
+        "prefix": "hyp003_achievem",
+        "numerator": "hyp003_numerator",
+        "denominator": "hyp003_denominator",
+        "counts": ["hyp003_numerator", "hyp003_denominator", "population"],
+    },
+    "hyp007": {
+        "prefix": "hyp007_achievem",
+        "numerator": "hyp007_numerator",
+        "denominator": "hyp007_denominator",
+        "counts": ["hyp007_numerator", "hyp007_denominator", "population"],
+    },
+    "bp002_1y_hypreg": {
+        "prefix": "bp002_1y_achievem",
+        "numerator": "bp002_numerator",
+        "denominator": "population",
+        "counts": ["bp002_numerator", "population"],
+    },
+}
+
+
+def measure_files(input_dir, prefix):
+    # Combined measure files of an indicator: grouped measures (excluding
+    # practice) followed by the population measure. The per-month files
+    # (measure_<id>_<date>.csv) are skipped, their rows are already in the
+    # combined files.
+    paths = sorted(glob.glob(os.path.join(input_dir, f"measure_{prefix}_*.csv")))
+    names = [os.path.basename(path) for path in paths]
+    names = [
+        name
+        for name in names
+        if not re.search(r"_\d{4}-\d{2}-\d{2}\.csv$", name) and "practice" not in name
+    ]
+    groups = [name for name in names if "population" not in name]
+    population = [name for name in names if "population" in name]
+    return [os.path.join(input_dir, name) for name in groups + population]
+
+
+def output_schema(indicator):
+    fields = [
+        ("group", pa.string()),
+        ("category", pa.string()),
+        ("date", pa.date32()),
+    ]
+    fields += [(count, pa.float64()) for count in indicator["counts"]]
+    fields += [("value", pa.float64())]
+    return pa.schema(fields)
+
+
+def is_logical(values):
+    # Whether readr would parse a breakdown as logical: every value that
+    # isn't missing is TRUE or FALSE, e.g. care_home or learning_disability
+    values = values.dropna()
+    return len(values) > 0 and values.isin(LOGICAL_CATEGORIES.keys()).all()
+
+
+def tidy_chunk(chunk, breakdown, indicator, schema, logical=False):
+    # Pivot the breakdown column, round counts to the nearest 10 and
+    # recalculate the value from the rounded counts
+    if breakdown is None:
+        chunk = chunk.assign(group="population", category="population")
+    else:
+        chunk = chunk.rename(columns={breakdown: "category"}).assign(group=breakdown)
+        if logical:
+            chunk["category"] = chunk["category"].map(LOGICAL_CATEGORIES)
+    chunk["date"] = pd.to_datetime(chunk["date"]).dt.date
+    for count in indicator["counts"]:
+        if count not in chunk:
+            chunk[count] = float("nan")
+        chunk[count] = round_counts(chunk[count])
+    chunk["value"] = chunk[indicator["numerator"]] / chunk[indicator["denominator"]]
+    return chunk[schema.names]
+
+
+def csv_values(chunk, indicator):
+    # Values as readr::write_csv wrote them: infinities as Inf and -Inf, and
+    # 0 / 0 as NaN, while the value of a missing count stays NA
+    value = chunk["value"].to_numpy()
+    counts = chunk[[indicator["numerator"], indicator["denominator"]]]
+    text = value.astype(object)
+    text[np.isposinf(value)] = "Inf"
+    text[np.isneginf(value)] = "-Inf"
+    text[np.isnan(value) & counts.notna().all(axis=1).to_numpy()] = "NaN"
+    return text
+
+
+def join_measures(input_dir, output_dir, name, indicator, chunksize=100_000):
+    schema = output_schema(indicator)
+    feather_path = os.path.join(output_dir, f"measures_{name}.feather")
+    csv_path = os.path.join(output_dir, f"measures_{name}.csv")
+    options = pa.ipc.IpcWriteOptions(compression="zstd")
+    rows = 0
+    with pa.OSFile(feather_path, "wb") as sink, pa.ipc.new_file(
+        sink, schema, options=options
+    ) as writer, open(csv_path, "w", newline="") as csv_file:
+        header = True
+        for path in measure_files(input_dir, indicator["prefix"]):
+            # The breakdown of grouped measures is their first column, read
+            # as text so that categories have the same type across measures.
+            # Like readr, whether it is logical is guessed from the first rows.
+            breakdown = None
+            dtype = None
+            logical = None
+            if "population" not in os.path.basename(path):
+                breakdown = pd.read_csv(path, nrows=0).columns[0]
+                dtype = {breakdown: str}
+            for chunk in pd.read_csv(path, chunksize=chunksize, dtype=dtype):
+                if breakdown is not None and logical is None:
+                    logical = is_logical(chunk[breakdown])
+                chunk = tidy_chunk(chunk, breakdown, indicator, schema, logical)
+                writer.write_table(
+                    pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+                )
+                # Rounded counts are written as whole numbers
+                chunk.astype({count: "Int64" for count in indicator["counts"]}).assign(
+                    value=csv_values(chunk, indicator)
+                ).to_csv(csv_file, header=header, index=False, na_rep="NA")
+                header = False
+                rows += len(chunk)
+        if header:
+            csv_file.write(",".join(schema.names) + "\n")
+    return rows
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Join the measures of each indicator and round counts"
+    )
+    parser.add_argument("--input-dir", default="output/indicators/joined")
+    parser.add_argument("--output-dir", default="output/indicators/joined/measures")
+    parser.add_argument(
+        "--indicator",
+        nargs="+",
+        choices=list(INDICATORS),
+        default=list(INDICATORS),
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    for name in args.indicator:
+        rows = join_measures(args.input_dir, args.output_dir, name, INDICATORS[name])
+        print(f"Joined {rows} rows into measures_{name}")
+
+
+if __name__ == "__main__":
+    main()
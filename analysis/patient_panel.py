@@ -0,0 +1,162 @@
+# Patient level panel of the monthly cohorts of a study
+#
+# Following patients across months (e.g. who moves in and out of the HYP003
+# denominator, or which rule rejects them) would otherwise mean reading and
+# joining every monthly cohort. This script reads only the requested columns
+# of each monthly cohort once and writes a single file in one of two layouts:
+#
+# - long (panel_long_<study>.feather): one row per patient and month, with
+#   patient_id, index_date and the selected variables, sorted by patient and
+#   month
+# - flags (panel_flags_<study>.feather): one row per patient, with each
+#   boolean variable (hyp_reg, the denominators, numerators and every rule by
+#   default) packed into a 64-bit integer whose bit i is the value in month i,
+#   and `in_cohort` marking the months the patient was in the cohort. The
+#   months of the bits are stored in the file's metadata.
+#
+# read_flags() reads a flags panel back with its months, and flag_matrix()
+# unpacks a flag into a patients x months boolean matrix.
+#
+# Usage:
+# python analysis/patient_panel.py \
+#   --study-definition study_definition_hyp003 \
+#   --input-dir output/indicators/joined \
+#   --output-dir output/indicators/joined/panel \
+#   --format flags
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from feather_io import read_feather, read_table
+from generate_measures import cohort_files, study_suffix
+
+MONTHS_KEY = b"months"
+
+# Months that fit in the bits of one flag
+MAX_MONTHS = 64
+
+IN_COHORT = "in_cohort"
+
+
+def panel_path(output_dir, layout, suffix):
+    return os.path.join(output_dir, f"panel_{layout}{suffix}.feather")
+
+
+def flag_columns(path):
+    # Boolean columns of a cohort, from its schema only
+    with pa.memory_map(path) as source:
+        schema = pa.ipc.open_file(source).schema
+    return [field.name for field in schema if pa.types.is_boolean(field.type)]
+
+
+def long_panel(cohorts, variables):
+    frames = []
+    for date, path in cohorts:
+        df = read_feather(path, columns=["patient_id", *variables])
+        df.insert(1, "index_date", pd.Timestamp(date))
+        frames.append(df)
+    df = pd.concat(frames, ignore_index=True)
+    # Months are already in order, so a stable sort keeps them in order for
+    # each patient
+    order = np.argsort(df["patient_id"].to_numpy(), kind="stable")
+    return pa.Table.from_pandas(df.iloc[order], preserve_index=False)
+
+
+def flags_panel(cohorts, flags):
+    if len(cohorts) > MAX_MONTHS:
+        raise ValueError(
+            f"{len(cohorts)} months don't fit in {MAX_MONTHS} bits; "
+            "split the index date range"
+        )
+    # Every patient in the cohort in any month, then one bit per month
+    patient_ids = np.unique(
+        np.concatenate(
+            [
+                read_table(path, columns=["patient_id"])["patient_id"].to_numpy()
+                for _, path in cohorts
+            ]
+        )
+    )
+    bits = {
+        name: np.zeros(len(patient_ids), dtype=np.uint64)
+        for name in [IN_COHORT, *flags]
+    }
+    for month, (_, path) in enumerate(cohorts):
+        df = read_feather(path, columns=["patient_id", *flags])
+        positions = np.searchsorted(patient_ids, df["patient_id"].to_numpy())
+        bit = np.uint64(1) << np.uint64(month)
+        bits[IN_COHORT][positions] |= bit
+        for name in flags:
+            values = df[name].to_numpy(dtype=bool)
+            bits[name][positions[values]] |= bit
+    table = pa.table({"patient_id": patient_ids, **bits})
+    months = [date for date, _ in cohorts]
+    return table.replace_schema_metadata({MONTHS_KEY: json.dumps(months).encode()})
+
+
+def write_panel(input_dir, output_dir, study_name, layout, variables=None):
+    suffix = study_suffix(study_name)
+    cohorts = cohort_files(input_dir, suffix)
+    if not cohorts:
+        raise FileNotFoundError(f"No cohorts of {study_name} in {input_dir}")
+    if layout == "long":
+        if not variables:
+            raise ValueError("The long panel needs the variables to include")
+        table = long_panel(cohorts, variables)
+    else:
+        flags = variables or flag_columns(cohorts[-1][1])
+        table = flags_panel(cohorts, flags)
+    os.makedirs(output_dir, exist_ok=True)
+    path = panel_path(output_dir, layout, suffix)
+    feather.write_feather(table, f"{path}.tmp", compression="zstd")
+    os.replace(f"{path}.tmp", path)
+    return path, table.num_rows
+
+
+def read_flags(path, columns=None):
+    # Flags panel and the months of its bits
+    table = read_table(path, columns=columns)
+    months = json.loads(table.schema.metadata[MONTHS_KEY])
+    return table.to_pandas(), months
+
+
+def flag_matrix(values, months):
+    # Patients x months boolean matrix of a packed flag
+    shifts = np.arange(len(months), dtype=np.uint64)
+    values = np.asarray(values, dtype=np.uint64)
+    return ((values[:, None] >> shifts) & np.uint64(1)).astype(bool)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Write a patient level panel of the monthly cohorts of a study"
+    )
+    parser.add_argument("--study-definition", required=True, nargs="+")
+    parser.add_argument("--input-dir", default="output/indicators/joined")
+    parser.add_argument("--output-dir", default="output/indicators/joined/panel")
+    parser.add_argument("--format", choices=["long", "flags"], default="flags")
+    parser.add_argument(
+        "--variables",
+        nargs="+",
+        help="Variables to include (default for flags: every boolean variable)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    for study_name in args.study_definition:
+        path, rows = write_panel(
+            args.input_dir, args.output_dir, study_name, args.format, args.variables
+        )
+        print(f"Wrote {rows} rows to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+# Figures of the joined measures and practice deciles for the report
+#
+# The notebooks in notebooks/ read and tidy the released measures again every
+# time they are rendered. This script loads the joined measures of every
+# indicator (measures_<indicator>.csv from join_measures.py) and the practice
+# deciles (from deciles.py) once into a columnar store: feather files in the
+# cache directory named by a hash of the input files, so they are only
+# rebuilt when an input changes.
+#
+# It then renders one figure per indicator and breakdown, in the style of
+# plot_qof_values() in lib/functions/funs_plot_measures.R, and a deciles
+# figure per indicator, in the style of plot_qof_deciles(). Figures are
+# rendered in a process pool. The data of each figure is hashed and recorded
+# in report_figures_manifest.json in the output directory, so only figures
+# whose data changed are rendered again. Figures no longer among those of the
+# inputs are removed.
+#
+# Usage:
+# python analysis/report_figures.py \
+#   --measures-dir output/indicators/joined/measures \
+#   --deciles-file output/indicators/joined/deciles/deciles_hyp_practice.csv \
+#   --output-dir output/report
+
+import argparse
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from feather_io import read_feather
+
+MEASURES_FILE_RE = re.compile(r"^measures_(?P<indicator>.+)\.csv$")
+CACHE_FILE_RE = re.compile(r"^(measures|deciles)_[0-9a-f]{16}\.feather$")
+
+# Start of each QOF year, marked on every figure
+QOF_YEARS = ["2019-03-01", "2020-03-01", "2021-03-01", "2022-03-01"]
+
+# Line widths and colours of the deciles, from the 10th to the 90th percentile
+DECILE_WIDTHS = [0.8, 0.8, 1.0, 1.2, 1.6, 1.2, 1.0, 0.8, 0.8]
+DECILE_COLOURS = [
+    "#9ecae1",
+    "#6baed6",
+    "#4292c6",
+    "#2171b5",
+    "#084594",
+    "#2171b5",
+    "#4292c6",
+    "#6baed6",
+    "#9ecae1",
+]
+
+# Changing how figures are drawn invalidates all of them
+FIGURE_VERSION = "1"
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def frame_hash(df):
+    hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    return hashlib.sha256(FIGURE_VERSION.encode() + hashes.tobytes()).hexdigest()
+
+
+def measures_files(measures_dir):
+    files = {}
+    for file in sorted(os.listdir(measures_dir)):
+        match = MEASURES_FILE_RE.match(file)
+        if match:
+            files[match.group("indicator")] = os.path.join(measures_dir, file)
+    return files
+
+
+def tidy_measures(files):
+    frames = []
+    for indicator, path in files.items():
+        df = pd.read_csv(
+            path,
+            usecols=["group", "category", "date", "value"],
+            dtype={"group": str, "category": str},
+            parse_dates=["date"],
+        )
+        frames.append(df.assign(indicator=indicator))
+    df = pd.concat(frames, ignore_index=True)
+    return df[["indicator", "group", "category", "date", "value"]]
+
+
+def tidy_deciles(path):
+    return pd.read_csv(path, dtype={"indicator": str}, parse_dates=["date"])
+
+
+def load_store(measures_dir, deciles_file, cache_dir):
+    # Measures and deciles from the columnar store, building it first if the
+    # input files changed
+    files = measures_files(measures_dir)
+    inputs = list(files.values()) + ([deciles_file] if deciles_file else [])
+    key = hashlib.sha256(
+        repr([(os.path.basename(path), file_hash(path)) for path in inputs]).encode()
+    ).hexdigest()[:16]
+    measures_path = os.path.join(cache_dir, f"measures_{key}.feather")
+    deciles_path = os.path.join(cache_dir, f"deciles_{key}.feather")
+    if not os.path.exists(measures_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        tidy_measures(files).to_feather(f"{measures_path}.tmp")
+        os.replace(f"{measures_path}.tmp", measures_path)
+        if deciles_file:
+            tidy_deciles(deciles_file).to_feather(f"{deciles_path}.tmp")
+            os.replace(f"{deciles_path}.tmp", deciles_path)
+        # Stores of inputs that have since changed are never read again
+        for file in os.listdir(cache_dir):
+            if CACHE_FILE_RE.match(file) and key not in file:
+                os.remove(os.path.join(cache_dir, file))
+    measures = read_feather(measures_path)
+    deciles = read_feather(deciles_path) if deciles_file else None
+    return measures, deciles
+
+
+def figure_jobs(measures, deciles):
+    # (file name, kind, title, data) of every figure
+    jobs = []
+    for (indicator, group), df in measures.groupby(["indicator", "group"], sort=True):
+        jobs.append(
+            (
+                f"measures_{indicator}_{group}.png",
+                "values",
+                f"{indicator}: {group}",
+                df[["category", "date", "value"]].reset_index(drop=True),
+            )
+        )
+    if deciles is not None:
+        for indicator, df in deciles.groupby("indicator", sort=True):
+            jobs.append(
+                (
+                    f"deciles_{indicator}.png",
+                    "deciles",
+                    f"{indicator}: practice level deciles",
+                    df[["percentile", "date", "value"]].reset_index(drop=True),
+                )
+            )
+    return jobs
+
+
+def _axes(title):
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from matplotlib.ticker import PercentFormatter
+
+    fig, ax = plt.subplots(figsize=(8, 5))
+    for year in QOF_YEARS:
+        ax.axvline(pd.Timestamp(year), linestyle=":", color="orange", linewidth=1)
+    ax.yaxis.set_major_formatter(PercentFormatter(1.0))
+    ax.set_title(title)
+    return fig, ax
+
+
+def render_figure(path, kind, title, df):
+    import matplotlib.pyplot as plt
+
+    fig, ax = _axes(title)
+    if kind == "values":
+        categories = sorted(df["category"].dropna().unique())
+        colours = plt.get_cmap("viridis_r")(
+            [i / max(len(categories) - 1, 1) for i in range(len(categories))]
+        )
+        for category, colour in zip(categories, colours):
+            rows = df[df["category"] == category].sort_values("date")
+            ax.plot(
+                rows["date"],
+                rows["value"],
+                marker="o",
+                markersize=2,
+                linewidth=1,
+                color=colour,
+                label=category,
+            )
+    else:
+        for percentile, width, colour in zip(
+            range(10, 100, 10), DECILE_WIDTHS, DECILE_COLOURS
+        ):
+            rows = df[df["percentile"] == percentile].sort_values("date")
+            ax.plot(
+                rows["date"],
+                rows["value"],
+                marker="o",
+                markersize=2,
+                linewidth=width,
+                color=colour,
+                label=str(percentile),
+            )
+        ax.set_ylim(0, 1)
+    ax.legend(loc="upper center", bbox_to_anchor=(0.5, -0.08), ncol=5, frameon=False)
+    fig.tight_layout()
+    fig.savefig(f"{path}.tmp.png", dpi=150)
+    plt.close(fig)
+    os.replace(f"{path}.tmp.png", path)
+    return path
+
+
+def manifest_path(output_dir):
+    return os.path.join(output_dir, "report_figures_manifest.json")
+
+
+def load_manifest(output_dir):
+    path = manifest_path(output_dir)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(output_dir, manifest):
+    path = manifest_path(output_dir)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+
+def render_report(measures_dir, deciles_file, output_dir, cache_dir, workers=None):
+    measures, deciles = load_store(measures_dir, deciles_file, cache_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_manifest(output_dir)
+    jobs = figure_jobs(measures, deciles)
+    # Figures of indicators or breakdowns that are no longer in the inputs are
+    # removed, with their entries in the manifest
+    stale = set(manifest) - {name for name, _, _, _ in jobs}
+    for name in stale:
+        del manifest[name]
+        path = os.path.join(output_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
+    if stale:
+        save_manifest(output_dir, manifest)
+    pending = []
+    for name, kind, title, df in jobs:
+        path = os.path.join(output_dir, name)
+        current = frame_hash(df)
+        if manifest.get(name) == current and os.path.exists(path):
+            continue
+        pending.append((name, current, (path, kind, title, df)))
+    if pending:
+        # Figures rendered before one fails are still recorded, so they aren't
+        # rendered again on the next run
+        error = None
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [
+                    (name, current, pool.submit(render_figure, *args))
+                    for name, current, args in pending
+                ]
+                for name, current, future in futures:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        error = error or e
+                        continue
+                    manifest[name] = current
+        finally:
+            save_manifest(output_dir, manifest)
+        if error is not None:
+            raise error
+    return len(pending), len(manifest)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Render the report figures of the joined measures and deciles"
+    )
+    parser.add_argument("--measures-dir", default="output/indicators/joined/measures")
+    parser.add_argument(
+        "--deciles-file",
+        default="output/indicators/joined/deciles/deciles_hyp_practice.csv",
+        help="Deciles from deciles.py, or an empty string to leave them out",
+    )
+    parser.add_argument("--output-dir", default="output/report")
+    parser.add_argument("--cache-dir", default="output/report/cache")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of figures rendered in parallel (default: one per CPU)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    rendered, total = render_report(
+        args.measures_dir,
+        args.deciles_file or None,
+        args.output_dir,
+        args.cache_dir,
+        args.workers,
+    )
+    print(f"Rendered {rendered} of {total} figures to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,491 @@
+# Compiled evaluation of `patients.satisfying()` and `patients.categorised_as()`
+# business rules over columnar data
+#
+# The HYP003 and HYP007 denominators are built from dozens of expressions
+# that repeat the same sub-expressions, e.g. every flowchart step starts with
+# "hyp003_denominator_r1 AND (NOT hyp003_denominator_r2)". This module parses
+# every expression of a study definition once into a single DAG of NumPy
+# array operations. Identical sub-expressions are the same node of the DAG,
+# so they are computed only once however many rules use them.
+#
+# Usage (recompute every rule column of already extracted cohorts):
+# python analysis/rule_engine.py \
+#   --study-definition study_definition_hyp003 \
+#   --input-files output/indicators/input_hyp003_*.feather
+
+import argparse
+import glob
+import importlib
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from date_utils import ISO_DATE_RE, MISSING_DATE, date_to_days, to_days
+from feather_io import read_feather
+
+# Tokens of the expression language used by `patients.satisfying()` and
+# `patients.categorised_as()`
+TOKEN_RE = re.compile(
+    r"\s*(?:(?P<comment>#[^\n]*)"
+    r"|(?P<string>'[^']*')"
+    r"|(?P<number>\d+(?:\.\d+)?)"
+    r"|(?P<name>[A-Za-z_]\w*)"
+    r"|(?P<comparison>>=|<=|!=|=|<|>)"
+    r"|(?P<operator>[-+*/])"
+    r"|(?P<paren>[()]))"
+)
+KEYWORDS = {"AND", "OR", "NOT"}
+
+COMPARISONS = {
+    "=": np.equal,
+    "!=": np.not_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+    ">": np.greater,
+    ">=": np.greater_equal,
+}
+OPERATORS = {
+    "+": np.add,
+    "-": np.subtract,
+    "*": np.multiply,
+    "/": np.true_divide,
+}
+
+
+def empty_value(query_args):
+    # cohortextractor treats these values as "no value" in expressions
+    if query_args.get("returning") == "index_of_multiple_deprivation":
+        return -1
+    if query_args.get("column_type") in ("str", "date"):
+        return ""
+    return 0
+
+
+def tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN_RE.match(expression, position)
+        if not match or match.end() == position:
+            raise ValueError(f"Invalid expression: {expression}")
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "comment":
+            continue
+        if kind == "name" and value in KEYWORDS:
+            kind = "keyword"
+        tokens.append((kind, value))
+    return tokens
+
+
+def column_names(expression):
+    return {value for kind, value in tokenize(expression) if kind == "name"}
+
+
+def is_expression(query_type):
+    return query_type == "categorised_as"
+
+
+def rule_categories(query_args):
+    # Every category of a string rule column, in sorted order. Extracted
+    # cohorts have these categories whichever of them occur in a month.
+    return sorted(set(query_args["category_definitions"]) - {""})
+
+
+class RuleProgram:
+    # All `categorised_as` columns of a study definition (which includes every
+    # `satisfying` column) compiled into one DAG. Nodes are tuples that are
+    # interned, so structurally identical sub-expressions share a node id.
+    # Node ids are assigned in creation order, which is a topological order.
+    #
+    # Columns listed in `given` are read from the input frame rather than
+    # computed, e.g. rule columns taken from an existing cohort file.
+    def __init__(self, covariate_definitions, given=()):
+        self.nodes = []
+        self.kinds = []
+        self._ids = {}
+        self.columns = {}
+        self.inputs = set()
+        self.expression_count = 0
+        self.column_types = {}
+        self.empty_values = {}
+        for name, (query_type, query_args) in covariate_definitions.items():
+            self.column_types[name] = query_args.get("column_type")
+            self.empty_values[name] = empty_value(query_args)
+            if is_expression(query_type) and name not in given:
+                self.columns[name] = self._compile_column(name, query_args)
+
+    # Compilation
+
+    def _node(self, kind, *node):
+        if node not in self._ids:
+            self._ids[node] = len(self.nodes)
+            self.nodes.append(node)
+            self.kinds.append(kind)
+        return self._ids[node]
+
+    def _compile_column(self, name, query_args):
+        default = None
+        conditions = []
+        for category, expression in query_args["category_definitions"].items():
+            if expression.strip() == "DEFAULT":
+                default = category
+                continue
+            conditions.append((category, self.compile_expression(expression)))
+            self.expression_count += 1
+        column_type = query_args.get("column_type")
+        return self._node(
+            column_type, "case", name, column_type, default, tuple(conditions)
+        )
+
+    def compile_expression(self, expression):
+        tokens = self._insert_implicit_comparisons(tokenize(expression))
+        parser = _Parser(self, tokens)
+        node = parser.parse_or()
+        if parser.position != len(tokens):
+            raise ValueError(f"Unexpected token in expression: {expression}")
+        return node
+
+    def _insert_implicit_comparisons(self, tokens):
+        # Columns which are not compared to anything are compared against
+        # their "empty" value, as cohortextractor does, so that e.g.
+        # "hyp AND hyp_res_date" means "hyp != 0 AND hyp_res_date != ''"
+        output = []
+        for n, (kind, value) in enumerate(tokens):
+            previous = tokens[n - 1][0] if n > 0 else None
+            following = tokens[n + 1][0] if n + 1 < len(tokens) else None
+            is_compared = "comparison" in (previous, following)
+            is_combined = "operator" in (previous, following)
+            if kind == "name" and not is_compared and not is_combined:
+                output.extend(
+                    [
+                        ("paren", "("),
+                        (kind, value),
+                        ("comparison", "!="),
+                        ("empty", self.empty_values[value]),
+                        ("paren", ")"),
+                    ]
+                )
+            else:
+                output.append((kind, value))
+        return output
+
+    def column_node(self, name):
+        if name in self.columns:
+            return self.columns[name]
+        if name not in self.column_types:
+            raise ValueError(f"Unknown column '{name}'")
+        self.inputs.add(name)
+        return self._node(self.column_types[name], "input", name)
+
+    def literal_node(self, value):
+        kind = "str" if isinstance(value, str) else "float"
+        return self._node(kind, "literal", value)
+
+    def compare_node(self, comparison, left, right):
+        # Dates are held as days, so empty and ISO date literals compared
+        # with date columns are converted to days as well
+        if self.kinds[left] == "date" and self.nodes[right][0] == "literal":
+            right = self._date_literal(right)
+        if self.kinds[right] == "date" and self.nodes[left][0] == "literal":
+            left = self._date_literal(left)
+        return self._node("bool", "compare", comparison, left, right)
+
+    def _date_literal(self, node):
+        value = self.nodes[node][1]
+        if value == "":
+            return self._node("date", "literal", MISSING_DATE)
+        if isinstance(value, str) and ISO_DATE_RE.match(value):
+            return self._node("date", "literal", int(date_to_days(value)))
+        return node
+
+    # Evaluation
+
+    def required_nodes(self, names):
+        # Ids of every node needed to compute the given columns, in order
+        needed = set()
+        stack = [self.columns[name] for name in names]
+        while stack:
+            node_id = stack.pop()
+            if node_id in needed:
+                continue
+            needed.add(node_id)
+            stack.extend(self._children(self.nodes[node_id]))
+        return sorted(needed)
+
+    def required_inputs(self, names):
+        return {
+            self.nodes[node_id][1]
+            for node_id in self.required_nodes(names)
+            if self.nodes[node_id][0] == "input"
+        }
+
+    def _children(self, node):
+        op = node[0]
+        if op in ("input", "literal"):
+            return []
+        if op == "case":
+            return [condition for _, condition in node[4]]
+        if op in ("compare", "arith"):
+            return [node[2], node[3]]
+        return list(node[1:])
+
+    def shared_node_count(self):
+        # Nodes used by more than one rule or sub-expression
+        references = np.zeros(len(self.nodes), dtype=int)
+        for node in self.nodes:
+            for child in self._children(node):
+                references[child] += 1
+        return int((references > 1).sum())
+
+    def evaluator(self, frame):
+        return RuleEvaluator(self, frame)
+
+    def evaluate(self, frame, names=None):
+        names = list(self.columns) if names is None else names
+        evaluator = self.evaluator(frame)
+        return {name: evaluator.column(name) for name in names}
+
+
+class RuleEvaluator:
+    # Evaluates nodes of a program over a frame (a mapping of column name to
+    # NumPy array), computing each node at most once
+    def __init__(self, program, frame):
+        self.program = program
+        self.frame = frame
+        self.values = {}
+
+    def column(self, name):
+        if name in self.frame:
+            return self.frame[name]
+        for node_id in self.program.required_nodes([name]):
+            if node_id not in self.values:
+                self.values[node_id] = self._apply(self.program.nodes[node_id])
+        return self.values[self.program.columns[name]]
+
+    def _apply(self, node):
+        op = node[0]
+        values = self.values
+        if op == "input":
+            return self.frame[node[1]]
+        if op == "literal":
+            return node[1]
+        if op == "not":
+            return ~np.asarray(values[node[1]], dtype=bool)
+        if op == "neg":
+            return -values[node[1]]
+        if op == "and":
+            return values[node[1]] & values[node[2]]
+        if op == "or":
+            return values[node[1]] | values[node[2]]
+        if op == "compare":
+            return COMPARISONS[node[1]](values[node[2]], values[node[3]])
+        if op == "arith":
+            return OPERATORS[node[1]](values[node[2]], values[node[3]])
+        if op == "case":
+            # Rule columns already in the frame (e.g. shared with another
+            # study definition) are not computed again
+            if node[1] in self.frame:
+                return self.frame[node[1]]
+            return self._case(*node[2:])
+        raise ValueError(f"Unknown node: {node}")
+
+    def _case(self, column_type, default, conditions):
+        size = len(next(iter(self.frame.values())))
+        if column_type == "bool":
+            values = np.zeros(size, dtype=bool)
+        elif column_type == "str":
+            values = np.full(size, "", dtype=object)
+        else:
+            values = np.zeros(size, dtype=np.int64)
+        if default is not None:
+            values[:] = default
+        assigned = np.zeros(size, dtype=bool)
+        for category, condition in conditions:
+            matches = np.asarray(self.values[condition], dtype=bool) & ~assigned
+            values[matches] = category
+            assigned |= matches
+        return values
+
+
+class _Parser:
+    # Recursive descent parser producing DAG nodes, with SQL precedence:
+    # arithmetic, comparison, NOT, AND, OR
+    def __init__(self, program, tokens):
+        self.program = program
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def parse_or(self):
+        node = self.parse_and()
+        while self.peek() == ("keyword", "OR"):
+            self.take()
+            node = self.program._node("bool", "or", node, self.parse_and())
+        return node
+
+    def parse_and(self):
+        node = self.parse_not()
+        while self.peek() == ("keyword", "AND"):
+            self.take()
+            node = self.program._node("bool", "and", node, self.parse_not())
+        return node
+
+    def parse_not(self):
+        if self.peek() == ("keyword", "NOT"):
+            self.take()
+            return self.program._node("bool", "not", self.parse_not())
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        left = self.parse_sum()
+        if self.peek()[0] != "comparison":
+            return left
+        _, comparison = self.take()
+        return self.program.compare_node(comparison, left, self.parse_sum())
+
+    def parse_sum(self):
+        node = self.parse_term()
+        while self.peek() in (("operator", "+"), ("operator", "-")):
+            _, operator = self.take()
+            node = self.program._node(
+                "float", "arith", operator, node, self.parse_term()
+            )
+        return node
+
+    def parse_term(self):
+        node = self.parse_factor()
+        while self.peek() in (("operator", "*"), ("operator", "/")):
+            _, operator = self.take()
+            node = self.program._node(
+                "float", "arith", operator, node, self.parse_factor()
+            )
+        return node
+
+    def parse_factor(self):
+        kind, value = self.take()
+        if kind == "paren" and value == "(":
+            node = self.parse_or()
+            if self.take() != ("paren", ")"):
+                raise ValueError("Unbalanced parentheses in expression")
+            return node
+        if kind == "operator" and value == "-":
+            return self.program._node("float", "neg", self.parse_factor())
+        if kind == "name":
+            return self.program.column_node(value)
+        if kind == "number":
+            return self.program.literal_node(
+                float(value) if "." in value else int(value)
+            )
+        if kind == "string":
+            return self.program.literal_node(value[1:-1])
+        if kind == "empty":
+            return self.program.literal_node(value)
+        raise ValueError(f"Unexpected token: {value}")
+
+
+# Recomputing rules on extracted cohorts
+
+
+def frame_from_dataframe(df, column_types):
+    # Convert cohort columns to the arrays used by the local extraction
+    frame = {}
+    for name in df.columns:
+        column_type = column_types.get(name)
+        values = df[name]
+        if column_type == "date":
+            frame[name] = to_days(values)
+        elif column_type == "str":
+            frame[name] = values.astype(object).fillna("").to_numpy(object)
+        elif column_type == "bool":
+            frame[name] = values.fillna(False).to_numpy(bool)
+        else:
+            # Missing values (e.g. of a float column) are kept, as in the
+            # extraction, so comparisons with them are False
+            frame[name] = values.to_numpy()
+    return frame
+
+
+def recompute_rules(study, df):
+    # Recompute every rule column of a cohort whose inputs are available.
+    # Rules depending on hidden columns (which are not written to the cohort)
+    # and the population are kept as extracted.
+    definitions = study.covariate_definitions
+    available = set(df.columns)
+    given = {"population"}
+    for name, (query_type, query_args) in definitions.items():
+        if not is_expression(query_type) or name in given:
+            continue
+        for expression in query_args["category_definitions"].values():
+            if not column_names(expression) - {"DEFAULT"} <= available:
+                given.add(name)
+                break
+        else:
+            available.add(name)
+    program = RuleProgram(definitions, given=given)
+    names = [name for name in program.columns if name in df.columns]
+    # Only the columns the rules use are loaded, leaving other columns (e.g.
+    # the joined ethnicity columns) untouched
+    inputs = program.required_inputs(names) | {"patient_id"}
+    columns = [name for name in df.columns if name in inputs and name not in names]
+    frame = frame_from_dataframe(df[columns], program.column_types)
+    for name, values in program.evaluate(frame, names).items():
+        if program.column_types[name] == "str":
+            df[name] = pd.Categorical(
+                pd.Series(values).replace("", None),
+                categories=rule_categories(definitions[name][1]),
+            )
+        else:
+            df[name] = values
+    return df, program, names
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Recompute the business rule columns of extracted cohorts"
+    )
+    parser.add_argument("--study-definition", required=True)
+    parser.add_argument("--input-files", required=True, nargs="+")
+    parser.add_argument(
+        "--output-dir",
+        help="Where to write the updated cohorts (default: overwrite inputs)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    study = importlib.import_module(args.study_definition).study
+    paths = sorted(p for pattern in args.input_files for p in glob.glob(pattern))
+    for path in paths:
+        df, program, names = recompute_rules(study, read_feather(path))
+        output_dir = args.output_dir or os.path.dirname(path)
+        os.makedirs(output_dir, exist_ok=True)
+        # The input is memory-mapped, so it is replaced rather than
+        # overwritten in place
+        output_path = os.path.join(output_dir, os.path.basename(path))
+        df.to_feather(f"{output_path}.tmp")
+        os.replace(f"{output_path}.tmp", output_path)
+    if paths:
+        print(
+            f"Recomputed {len(names)} rule columns in {len(paths)} files from "
+            f"{program.expression_count} expressions compiled to "
+            f"{len(program.nodes)} operations ({program.shared_node_count()} shared)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,12 @@
 from cohortextractor import StudyDefinition, patients, Measure
 
-import json
-import pandas as pd
-
-# Import dates and codelists
+# Import dates
 from config import (
     start_date,
     end_date,
     demographic_breakdowns,
 )
 
-from codelists import bp_codes, bp_dec_codes
-
 # Import shared variable dictionaries
 from dict_bp_variables import bp002_variables_1y_lookback
 from dict_demo_variables import demographic_variables
@@ -1,14 +1,7 @@
-from cohortextractor import (
-    StudyDefinition,
-    patients,
-    codelist,
-    codelist_from_csv,
-    Measure,
-)
+from cohortextractor import StudyDefinition, patients
 
 from config import end_date
 from codelists import ethnicity6_codes, ethnicity16_codes
-from dict_demo_variables import demographic_variables
 
 study = StudyDefinition(
     default_expectations={
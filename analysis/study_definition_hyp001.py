@@ -1,9 +1,6 @@
 from cohortextractor import StudyDefinition, patients, Measure
 
-import json
-import pandas as pd
 from config import start_date, end_date, demographic_breakdowns
-from codelists import hyp_codes, hyp_res_codes
 from dict_hyp_variables import hyp_reg_variables
 from dict_demo_variables import demographic_variables
 
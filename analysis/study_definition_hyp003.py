@@ -3,8 +3,6 @@ from cohortextractor import (
     patients,
     Measure,
 )
-import json
-import pandas as pd
 from config import (
     start_date,
     end_date,
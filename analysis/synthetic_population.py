@@ -0,0 +1,330 @@
+# Synthetic source tables for the local extraction
+#
+# Generates patients, registrations, addresses and clinical events in the
+# layout read by extract_monthly.py, at any population size, with codes drawn
+# from the codelists in codelists/. The rates are loosely based on QOF
+# hypertension prevalence (around 14%) so that the registers, exclusions and
+# blood pressure readings of every indicator are populated; the data is not
+# meant to be realistic beyond that.
+#
+# Patients are generated in chunks that are written as they are generated, so
+# memory use is bounded by the chunk size rather than the population size.
+#
+# Usage:
+# python analysis/synthetic_population.py \
+#   --size 1000000 \
+#   --output-dir output/source
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+import codelists
+
+REGIONS = [
+    "North East",
+    "North West",
+    "Yorkshire and The Humber",
+    "East Midlands",
+    "West Midlands",
+    "East",
+    "London",
+    "South East",
+    "South West",
+]
+
+# Average number of patients per practice, and the fewest practices of a
+# population, so that even small populations are spread across practices (and
+# their regions) for the practice level measures and deciles
+PRACTICE_SIZE = 8_000
+MIN_PRACTICES = 20
+
+# Events are generated between these dates, covering the 12 month lookbacks
+# of the first index dates
+EVENTS_START = np.datetime64("2017-01-01")
+EVENTS_END = np.datetime64("2023-03-31")
+
+# Events per patient (Poisson rates) of each cluster, for patients on the
+# hypertension register and for everyone else. Blood pressure readings are
+# rates per year, the others are per patient.
+HYPERTENSION_EVENTS = {
+    "hyp_res_codes": 0.03,
+    "ht_max_codes": 0.05,
+    "hyp_pca_pu_codes": 0.03,
+    "bp_dec_codes": 0.03,
+    "hyp_pca_dec_codes": 0.03,
+    "hyp_invite_codes": 0.6,
+}
+OTHER_EVENTS = {
+    "learning_disability_codes": 0.005,
+    "nhse_care_homes_codes": 0.01,
+}
+BP_READINGS_PER_YEAR = {"hypertension": 1.5, "other": 0.3}
+
+TABLES = ["patients", "registrations", "addresses", "clinical_events"]
+
+
+def codes(codelist):
+    if codelist and isinstance(codelist[0], tuple):
+        return np.array([str(code) for code, _ in codelist], dtype=object)
+    return np.array([str(code) for code in codelist], dtype=object)
+
+
+def random_dates(rng, n, start, end):
+    days = (end - start).astype(int)
+    return start + rng.integers(0, days + 1, n).astype("timedelta64[D]")
+
+
+def generate_chunk(rng, first_id, n, size):
+    # Source tables for patients first_id, ..., first_id + n - 1
+    patient_id = np.arange(first_id, first_id + n)
+    sex = rng.choice(np.array(["F", "M", "U"], dtype=object), n, p=[0.49, 0.49, 0.02])
+    date_of_birth = random_dates(
+        rng, n, np.datetime64("1920-01-01"), np.datetime64("2018-12-31")
+    )
+    age = (np.datetime64("2019-03-01") - date_of_birth).astype(int) / 365.25
+    dead = rng.random(n) < 0.04
+    date_of_death = np.where(
+        dead,
+        random_dates(rng, n, np.datetime64("2019-01-01"), EVENTS_END),
+        np.datetime64("NaT"),
+    )
+    patients = pd.DataFrame(
+        {
+            "patient_id": patient_id,
+            "sex": sex,
+            "date_of_birth": date_of_birth,
+            "date_of_death": date_of_death,
+        }
+    )
+
+    practices = min(size, max(MIN_PRACTICES, size // PRACTICE_SIZE))
+    practice = rng.integers(1, practices + 1, n)
+    left = rng.random(n) < 0.05
+    registrations = pd.DataFrame(
+        {
+            "patient_id": patient_id,
+            "practice": practice,
+            # Each practice is in one region
+            "region": np.array(REGIONS, dtype=object)[practice % len(REGIONS)],
+            "start_date": random_dates(
+                rng, n, np.datetime64("2000-01-01"), np.datetime64("2022-12-31")
+            ),
+            "end_date": np.where(
+                left,
+                random_dates(rng, n, np.datetime64("2019-01-01"), EVENTS_END),
+                np.datetime64("NaT"),
+            ),
+        }
+    )
+
+    imd = rng.integers(1, 32_845, n).astype(float)
+    imd[rng.random(n) < 0.02] = np.nan
+    addresses = pd.DataFrame(
+        {
+            "patient_id": patient_id,
+            "imd": imd,
+            "start_date": np.datetime64("2000-01-01"),
+            "end_date": np.datetime64("NaT"),
+        }
+    )
+
+    clinical_events = generate_events(rng, patient_id, age)
+    return {
+        "patients": patients,
+        "registrations": registrations,
+        "addresses": addresses,
+        "clinical_events": clinical_events,
+    }
+
+
+def generate_events(rng, patient_id, age):
+    # Hypertension becomes more common with age
+    n = len(patient_id)
+    hypertension = rng.random(n) < np.clip((age - 20) / 150, 0.005, 0.5)
+    events = [
+        # A diagnosis for everyone on the register, before or during the study
+        cluster_events(
+            rng,
+            patient_id[hypertension],
+            codes(codelists.hyp_codes),
+            np.ones(hypertension.sum()),
+            np.datetime64("2005-01-01"),
+            EVENTS_END,
+        )
+    ]
+    for name, rate in HYPERTENSION_EVENTS.items():
+        events.append(
+            cluster_events(
+                rng,
+                patient_id[hypertension],
+                codes(getattr(codelists, name)),
+                np.full(hypertension.sum(), rate),
+                EVENTS_START,
+                EVENTS_END,
+            )
+        )
+    for name, rate in OTHER_EVENTS.items():
+        events.append(
+            cluster_events(
+                rng,
+                patient_id,
+                codes(getattr(codelists, name)),
+                np.full(n, rate),
+                np.datetime64("2000-01-01"),
+                EVENTS_END,
+            )
+        )
+    # Most patients have an ethnicity recorded
+    events.append(
+        cluster_events(
+            rng,
+            patient_id,
+            codes(codelists.ethnicity16_codes),
+            np.full(n, 0.8),
+            np.datetime64("2000-01-01"),
+            EVENTS_END,
+        )
+    )
+    events.append(bp_readings(rng, patient_id, hypertension))
+    return pd.concat(events, ignore_index=True)
+
+
+def cluster_events(rng, patient_id, cluster_codes, rate, start, end):
+    counts = rng.poisson(rate)
+    patients = np.repeat(patient_id, counts)
+    return pd.DataFrame(
+        {
+            "patient_id": patients,
+            "code": rng.choice(cluster_codes, len(patients)),
+            "date": random_dates(rng, len(patients), start, end),
+            "numeric_value": np.nan,
+        }
+    )
+
+
+def bp_readings(rng, patient_id, hypertension):
+    # A blood pressure reading is a systolic and a diastolic value recorded on
+    # the same day, alongside a BP_COD code. The BP_COD code, which has no
+    # value, is one that is neither a systolic nor a diastolic code, so that
+    # it doesn't fall into the systolic and diastolic means.
+    bp_only_codes = np.setdiff1d(
+        codes(codelists.bp_codes),
+        np.concatenate([codes(codelists.bp_sys_codes), codes(codelists.bp_dia_codes)]),
+    )
+    years = (EVENTS_END - EVENTS_START).astype(int) / 365.25
+    rate = np.where(
+        hypertension,
+        BP_READINGS_PER_YEAR["hypertension"],
+        BP_READINGS_PER_YEAR["other"],
+    )
+    patients = np.repeat(patient_id, rng.poisson(rate * years))
+    n = len(patients)
+    dates = random_dates(rng, n, EVENTS_START, EVENTS_END)
+    systolic = np.round(rng.normal(138, 16, n))
+    diastolic = np.round(rng.normal(82, 10, n))
+    return pd.DataFrame(
+        {
+            "patient_id": np.tile(patients, 3),
+            "code": np.concatenate(
+                [
+                    rng.choice(codes(codelists.bp_sys_codes), n),
+                    rng.choice(codes(codelists.bp_dia_codes), n),
+                    rng.choice(bp_only_codes, n),
+                ]
+            ),
+            "date": np.tile(dates, 3),
+            "numeric_value": np.concatenate([systolic, diastolic, np.full(n, np.nan)]),
+        }
+    )
+
+
+SCHEMAS = {
+    "patients": pa.schema(
+        [
+            ("patient_id", pa.int64()),
+            ("sex", pa.string()),
+            ("date_of_birth", pa.timestamp("ns")),
+            ("date_of_death", pa.timestamp("ns")),
+        ]
+    ),
+    "registrations": pa.schema(
+        [
+            ("patient_id", pa.int64()),
+            ("practice", pa.int64()),
+            ("region", pa.string()),
+            ("start_date", pa.timestamp("ns")),
+            ("end_date", pa.timestamp("ns")),
+        ]
+    ),
+    "addresses": pa.schema(
+        [
+            ("patient_id", pa.int64()),
+            ("imd", pa.float64()),
+            ("start_date", pa.timestamp("ns")),
+            ("end_date", pa.timestamp("ns")),
+        ]
+    ),
+    "clinical_events": pa.schema(
+        [
+            ("patient_id", pa.int64()),
+            ("code", pa.string()),
+            ("date", pa.timestamp("ns")),
+            ("numeric_value", pa.float64()),
+        ]
+    ),
+}
+
+
+def generate_population(size, output_dir, seed=0, chunk_size=500_000):
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    options = pa.ipc.IpcWriteOptions(compression="zstd")
+    sinks = {}
+    writers = {}
+    rows = dict.fromkeys(TABLES, 0)
+    try:
+        for table in TABLES:
+            sinks[table] = pa.OSFile(os.path.join(output_dir, f"{table}.feather"), "wb")
+            writers[table] = pa.ipc.new_file(
+                sinks[table], SCHEMAS[table], options=options
+            )
+        for first_id in range(1, size + 1, chunk_size):
+            n = min(chunk_size, size + 1 - first_id)
+            for table, df in generate_chunk(rng, first_id, n, size).items():
+                writers[table].write_table(
+                    pa.Table.from_pandas(
+                        df, schema=SCHEMAS[table], preserve_index=False
+                    )
+                )
+                rows[table] += len(df)
+    finally:
+        for table in writers:
+            writers[table].close()
+        for table in sinks:
+            sinks[table].close()
+    return rows
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic source tables for the local extraction"
+    )
+    parser.add_argument("--size", type=int, default=10_000)
+    parser.add_argument("--output-dir", default="output/source")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    rows = generate_population(args.size, args.output_dir, seed=args.seed)
+    for table, count in rows.items():
+        print(f"Wrote {count} rows to {table}.feather")
+
+
+if __name__ == "__main__":
+    main()
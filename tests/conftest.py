@@ -0,0 +1,54 @@
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The analysis scripts import each other as top-level modules
+sys.path.insert(0, os.path.join(REPO_DIR, "analysis"))
+
+DUMMY_STUDY = "study_definition_hyp003"
+DUMMY_DATES = ["2021-02-01", "2021-03-01", "2021-04-01"]
+DUMMY_SIZE = 5_000
+SOURCE_SIZE = 2_000
+
+
+@pytest.fixture(scope="session")
+def dummy_dir(tmp_path_factory):
+    # Dummy HYP003 cohorts of a few months joined with a dummy ethnicity
+    # cohort, as written by dummy_cohorts.py
+    from dummy_cohorts import generate_dummy_cohorts
+    from extract_monthly import load_lookup
+
+    output_dir = tmp_path_factory.mktemp("dummy")
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        # Codelists are read relative to the repository
+        monkeypatch.chdir(REPO_DIR)
+        (ethnicity,) = generate_dummy_cohorts(
+            ["study_definition_ethnicity"],
+            DUMMY_DATES[:1],
+            DUMMY_SIZE,
+            str(output_dir / "ethnicity"),
+        )
+        generate_dummy_cohorts(
+            [DUMMY_STUDY],
+            DUMMY_DATES,
+            DUMMY_SIZE,
+            str(output_dir),
+            lookup=load_lookup(ethnicity),
+        )
+    return str(output_dir)
+
+
+@pytest.fixture(scope="session")
+def source(tmp_path_factory):
+    # A small synthetic population, as source tables for extract_monthly.py
+    from extract_monthly import load_source
+    from synthetic_population import generate_population
+
+    source_dir = tmp_path_factory.mktemp("source")
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.chdir(REPO_DIR)
+        generate_population(SOURCE_SIZE, str(source_dir))
+    return load_source(str(source_dir))
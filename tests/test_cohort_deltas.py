@@ -0,0 +1,131 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from cohort_deltas import iter_months, pack_cohorts, read_month, sort_cohort
+from conftest import DUMMY_STUDY
+from generate_measures import cohort_files
+
+STUDY = "study_definition_test"
+
+
+def draw(seed, size, categories):
+    # Values of every column for `size` patients
+    rng = np.random.default_rng(seed)
+    dates = pd.Timestamp("2020-01-01") + pd.to_timedelta(
+        rng.integers(0, 365, size), unit="D"
+    )
+    return {
+        "flag": rng.random(size) < 0.5,
+        "count": rng.integers(0, 5, size),
+        "value": np.where(rng.random(size) < 0.2, np.nan, rng.normal(size=size)),
+        "date": np.where(rng.random(size) < 0.2, np.datetime64("NaT"), dates),
+        "group": rng.choice(np.array([*categories, None], dtype=object), size),
+        "text": np.where(rng.random(size) < 0.1, None, "x"),
+    }
+
+
+def cohort(patient_ids, month, categories=("A", "B", "C")):
+    # Cohort as cohortextractor writes it: not sorted by patient, and with
+    # patient_id last. Patients keep their values from one month to the next,
+    # except for about a fifth of them, whose values are drawn again.
+    size = patient_ids.max() + 1
+    kept = draw(0, size, categories)
+    redrawn = draw(month, size, categories)
+    changed = np.random.default_rng([month, 1]).random(size) < 0.2
+    data = {
+        column: np.where(changed, redrawn[column], kept[column])[patient_ids]
+        for column in kept
+    }
+    data["group"] = pd.Categorical(data["group"], categories=categories)
+    data["patient_id"] = patient_ids
+    return pd.DataFrame(data)
+
+
+def write_cohorts(input_dir, cohorts):
+    os.makedirs(input_dir, exist_ok=True)
+    for date, df in cohorts.items():
+        df.to_feather(os.path.join(input_dir, f"input_test_{date}.feather"))
+
+
+def test_round_trip(tmp_path):
+    # Patients join and leave, and the categories of a column change
+    rng = np.random.default_rng(0)
+    ids = rng.permutation(np.arange(1_000))
+    cohorts = {
+        "2021-01-01": cohort(ids[:900], 1),
+        "2021-02-01": cohort(ids[50:950], 2),
+        "2021-03-01": cohort(ids[50:1_000], 3, categories=("C", "B", "A", "D")),
+        "2021-04-01": cohort(ids[100:1_000], 4),
+    }
+    write_cohorts(tmp_path / "input", cohorts)
+    pack_cohorts(str(tmp_path / "input"), str(tmp_path / "store"), STUDY)
+    kinds = sorted(file.split(".")[1] for file in os.listdir(tmp_path / "store"))
+    assert kinds == ["base", "delta", "delta", "delta"]
+    months = dict(iter_months(str(tmp_path / "store"), STUDY))
+    assert list(months) == list(cohorts)
+    for date, df in cohorts.items():
+        pd.testing.assert_frame_equal(months[date], sort_cohort(df))
+        columns = ["group", "date"]
+        pd.testing.assert_frame_equal(
+            read_month(str(tmp_path / "store"), STUDY, date, columns),
+            sort_cohort(df)[["patient_id", *columns]],
+        )
+
+
+def test_round_trip_of_dummy_cohorts(dummy_dir, tmp_path):
+    pack_cohorts(dummy_dir, str(tmp_path), DUMMY_STUDY, keyframe_interval=2)
+    files = dict(cohort_files(dummy_dir, "_hyp003"))
+    for date, df in iter_months(str(tmp_path), DUMMY_STUDY):
+        pd.testing.assert_frame_equal(df, sort_cohort(pd.read_feather(files[date])))
+
+
+def test_deltas_hold_only_changed_cells(tmp_path):
+    ids = np.arange(20_000)
+    first = cohort(ids, 1)
+    # One column changes for a few patients
+    second = first.copy()
+    second.loc[:99, "count"] += 1
+    write_cohorts(tmp_path / "input", {"2021-01-01": first, "2021-02-01": second})
+    pack_cohorts(str(tmp_path / "input"), str(tmp_path / "store"), STUDY)
+    base, delta = sorted(os.listdir(tmp_path / "store"))
+    assert delta.endswith(".delta.feather")
+    base_size = os.path.getsize(tmp_path / "store" / base)
+    assert os.path.getsize(tmp_path / "store" / delta) < base_size / 20
+
+
+def test_months_redrawn_every_month_are_keyframes(tmp_path):
+    # As in cohortextractor's dummy data, where patients are drawn again each
+    # month, so a delta would be no smaller than the cohort
+    rng = np.random.default_rng(0)
+    ids = rng.choice(1_000_000, 4_000, replace=False)
+    cohorts = {
+        date: pd.DataFrame(
+            {"patient_id": ids[i : i + 2_000], "value": rng.normal(size=2_000)}
+        )
+        for i, date in [(0, "2021-01-01"), (2_000, "2021-02-01")]
+    }
+    write_cohorts(tmp_path / "input", cohorts)
+    pack_cohorts(str(tmp_path / "input"), str(tmp_path / "store"), STUDY)
+    assert all(
+        file.endswith(".base.feather") for file in os.listdir(tmp_path / "store")
+    )
+    months = dict(iter_months(str(tmp_path / "store"), STUDY))
+    pd.testing.assert_frame_equal(
+        months["2021-02-01"], sort_cohort(cohorts["2021-02-01"])
+    )
+
+
+def test_repacking_removes_months_no_longer_in_the_input(tmp_path):
+    ids = np.arange(100)
+    cohorts = {
+        date: cohort(ids, i) for i, date in enumerate(["2021-01-01", "2021-02-01"])
+    }
+    write_cohorts(tmp_path / "input", cohorts)
+    pack_cohorts(str(tmp_path / "input"), str(tmp_path / "store"), STUDY)
+    os.remove(tmp_path / "input" / "input_test_2021-02-01.feather")
+    pack_cohorts(str(tmp_path / "input"), str(tmp_path / "store"), STUDY)
+    assert [date for date, _ in iter_months(str(tmp_path / "store"), STUDY)] == [
+        "2021-01-01"
+    ]
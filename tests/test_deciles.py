@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from deciles import PRACTICE_MEASURES, calculate_deciles
+from join_measures import INDICATORS
+
+DATES = ["2021-01-01", "2021-02-01"]
+
+
+def write_practice_measures(input_dir, rng):
+    # Practice measures of HYP001 and HYP003, with a few practices without
+    # any patients in the denominator. Those are given values too, so that
+    # leaving them out changes the deciles.
+    measures = {}
+    for indicator in ["hyp001", "hyp003"]:
+        denominator = INDICATORS[indicator]["denominator"]
+        n = 50
+        df = pd.DataFrame(
+            {
+                "practice": np.tile(np.arange(n), len(DATES)),
+                denominator: rng.integers(0, 40, n * len(DATES)),
+                "value": rng.random(n * len(DATES)),
+                "date": np.repeat(DATES, n),
+            }
+        )
+        df.to_csv(
+            os.path.join(input_dir, f"measure_{PRACTICE_MEASURES[indicator]}.csv"),
+            index=False,
+        )
+        measures[indicator] = df
+    return measures
+
+
+def test_deciles_match_numpy_percentiles(tmp_path):
+    measures = write_practice_measures(tmp_path, np.random.default_rng(0))
+    deciles = calculate_deciles(str(tmp_path), list(measures))
+    assert list(deciles.columns) == ["indicator", "date", "percentile", "value"]
+    assert len(deciles) == len(measures) * len(DATES) * 9
+    for indicator, df in measures.items():
+        denominator = INDICATORS[indicator]["denominator"]
+        for date in DATES:
+            # Practices with a zero denominator are left out
+            values = df[(df["date"] == date) & (df[denominator] > 0)]["value"]
+            rows = deciles[
+                (deciles["indicator"] == indicator) & (deciles["date"] == date)
+            ]
+            assert list(rows["percentile"]) == list(range(10, 100, 10))
+            np.testing.assert_allclose(
+                rows["value"], np.percentile(values, range(10, 100, 10))
+            )
@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+import pytest
+from cohortextractor.measure import Measure
+
+from disclosure import release, round_counts, suppress_small_numbers
+
+
+def cohortextractor_suppression(values):
+    data = pd.DataFrame({"numerator": np.asarray(values, dtype=float)})
+    measure = Measure("test", numerator="numerator", denominator="population")
+    measure._suppress_column("numerator", data, lambda message: None)
+    return data["numerator"].to_numpy()
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        # Nothing to suppress
+        [0, 6, 10, 100],
+        # Small values totalling more than 5
+        [3, 4, 20, 30],
+        # Small values totalling 5 or less, and the next smallest value
+        [2, 30, 20, 20],
+        [5, 6, 0],
+        # Only small values
+        [1, 2, 0],
+        # Missing values
+        [np.nan, 1, 7, 8],
+        [],
+    ],
+)
+def test_suppression_matches_cohortextractor(values):
+    np.testing.assert_array_equal(
+        suppress_small_numbers(np.asarray(values, dtype=float)),
+        cohortextractor_suppression(values),
+    )
+
+
+def test_random_suppression_matches_cohortextractor():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        values = rng.integers(0, 12, rng.integers(1, 8)).astype(float)
+        np.testing.assert_array_equal(
+            suppress_small_numbers(values.copy()), cohortextractor_suppression(values)
+        )
+
+
+def test_counts_are_rounded_to_the_nearest_10():
+    np.testing.assert_array_equal(
+        round_counts([0, 4, 6, 14, 15, 25, 1234, np.nan]),
+        [0, 0, 10, 10, 20, 20, 1230, np.nan],
+    )
+
+
+def test_release_recalculates_values_from_rounded_counts():
+    chunk = pd.DataFrame(
+        {
+            "numerator": [14.0, np.nan, 0.0, 6.0],
+            "denominator": [26.0, 40.0, 0.0, 4.0],
+            "value": [14 / 26, np.nan, np.nan, 1.5],
+        }
+    )
+    released = release(chunk)
+    np.testing.assert_array_equal(released["numerator"], [10, np.nan, 0, 10])
+    np.testing.assert_array_equal(released["denominator"], [30, 40, 0, 0])
+    np.testing.assert_array_equal(released["value"], [1 / 3, np.nan, np.nan, np.inf])
+    # The chunk itself is left as it was
+    assert chunk["numerator"][0] == 14
@@ -0,0 +1,145 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from date_utils import MISSING_DATE
+from event_index import MAX_CURSORS, EventIndex
+
+SIZE = 50
+
+
+@pytest.fixture
+def events():
+    # Events of most patients, sorted by patient and date, with repeated
+    # dates and a few events without a date. The last patients have none.
+    rng = np.random.default_rng(0)
+    n = 400
+    df = pd.DataFrame(
+        {
+            "patient": rng.integers(0, SIZE - 5, n),
+            "date": rng.integers(100, 160, n),
+            "value": rng.normal(size=n),
+        }
+    )
+    df.loc[rng.random(n) < 0.05, "date"] = MISSING_DATE
+    return df.sort_values(["patient", "date"], kind="stable", ignore_index=True)
+
+
+def make_index(df):
+    return EventIndex(
+        df["patient"].to_numpy(),
+        df["date"].to_numpy(),
+        SIZE,
+        value=df["value"].to_numpy(),
+    )
+
+
+def brute_force(df, start, end):
+    # Rows (of the events with a date) of each patient's events in the
+    # period, by filtering every event
+    df = df[df["date"] != MISSING_DATE].reset_index(drop=True)
+    start = np.broadcast_to(start, SIZE)
+    end = np.broadcast_to(end, SIZE)
+    patient = df["patient"].to_numpy()
+    within = (df["date"] >= start[patient]) & (df["date"] <= end[patient])
+    rows = df.index[within].to_series().groupby(patient[within])
+    first = rows.min().reindex(range(SIZE), fill_value=-1).to_numpy()
+    last = rows.max().reindex(range(SIZE), fill_value=-1).to_numpy()
+    count = rows.size().reindex(range(SIZE), fill_value=0).to_numpy()
+    return first, last, count
+
+
+def assert_matches(index, df, start, end):
+    first, last, count = brute_force(df, start, end)
+    np.testing.assert_array_equal(index.first(start, end), first)
+    np.testing.assert_array_equal(index.last(start, end), last)
+    np.testing.assert_array_equal(index.count(start, end), count)
+    lo, hi = index.window(start, end)
+    np.testing.assert_array_equal(hi - lo, count)
+
+
+@pytest.mark.parametrize(
+    "start, end",
+    [
+        (120, 140),
+        # Bounds on event dates, which are included
+        (100, 100),
+        (159, 159),
+        # Before and after every event
+        (0, 99),
+        (160, 1_000),
+        (MISSING_DATE + 1, 1_000),
+        # An empty period
+        (140, 120),
+    ],
+)
+def test_scalar_periods_match_brute_force(events, start, end):
+    assert_matches(make_index(events), events, start, end)
+
+
+def test_per_patient_periods_match_brute_force(events):
+    rng = np.random.default_rng(1)
+    start = rng.integers(90, 150, SIZE)
+    end = start + rng.integers(0, 30, SIZE)
+    assert_matches(make_index(events), events, start, end)
+    # Periods of a single day: each patient's events on a date they have
+    dated = events[events["date"] != MISSING_DATE]
+    day = dated.groupby("patient")["date"].first().reindex(range(SIZE), fill_value=0)
+    assert_matches(make_index(events), events, day.to_numpy(), day.to_numpy())
+
+
+def test_values_at(events):
+    index = make_index(events)
+    first, last, _ = brute_force(events, 110, 150)
+    dated = events[events["date"] != MISSING_DATE].reset_index(drop=True)
+    rows = index.last(110, 150)
+    values = index.values_at("value", rows, np.nan)
+    expected = np.where(last >= 0, dated["value"].to_numpy()[last], np.nan)
+    np.testing.assert_array_equal(values, expected)
+    dates = index.values_at("date", index.first(110, 150), MISSING_DATE)
+    expected = np.where(first >= 0, dated["date"].to_numpy()[first], MISSING_DATE)
+    np.testing.assert_array_equal(dates, expected)
+
+
+def test_rows(events):
+    index = make_index(events)
+    lo, hi = index.window(120, 140)
+    patients, rows = index.rows(lo, hi)
+    dated = events[events["date"] != MISSING_DATE].reset_index(drop=True)
+    expected = dated[dated["date"].between(120, 140)]
+    np.testing.assert_array_equal(rows, expected.index)
+    np.testing.assert_array_equal(patients, expected["patient"])
+
+
+def test_no_events():
+    index = EventIndex(np.array([], dtype=np.int64), np.array([], dtype=np.int64), 3)
+    np.testing.assert_array_equal(index.first(0, 100), [-1, -1, -1])
+    np.testing.assert_array_equal(index.count(0, 100), [0, 0, 0])
+
+
+def test_cursor_matches_binary_search(events):
+    # Periods stepped forward and backward, as when months are extracted
+    # out of order, with the same cursor
+    index = make_index(events)
+    fresh = make_index(events)
+    for start in [100, 110, 125, 125, 105, 90, 130, 159, 160, 120]:
+        end = start + 12
+        lo, hi = index.window(start, end, cursor="bp_12m")
+        expected_lo, expected_hi = fresh.window(start, end)
+        np.testing.assert_array_equal(lo, expected_lo, f"start {start}")
+        np.testing.assert_array_equal(hi, expected_hi, f"start {start}")
+        np.testing.assert_array_equal(
+            index.first(start, end, cursor="bp_first"), fresh.first(start, end)
+        )
+
+
+def test_cursors_are_bounded(events):
+    index = make_index(events)
+    for i in range(MAX_CURSORS + 5):
+        index.count(100, 120, cursor=f"variable_{i}")
+        index.count(110, 130, cursor=f"variable_{i}")
+    assert len(index._cursors) == MAX_CURSORS
+    # A dropped cursor starts again from a binary search
+    np.testing.assert_array_equal(
+        index.count(100, 140, cursor="variable_0"), make_index(events).count(100, 140)
+    )
@@ -0,0 +1,199 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import extract_monthly
+from config import end_date
+from conftest import DUMMY_DATES, DUMMY_STUDY, REPO_DIR
+from extract_monthly import CohortEngine, Source
+from extract_monthly import extract_monthly as run_extraction
+from extract_monthly import load_lookup, load_measures, measure_columns
+from feather_io import read_practices
+from generate_measures import calculate_measures
+
+
+def make_source(events):
+    patients = pd.DataFrame(
+        {
+            "patient_id": [1, 2, 3],
+            "sex": ["F", "M", "F"],
+            "date_of_birth": pd.to_datetime(["1950-01-01"] * 3),
+            "date_of_death": pd.to_datetime([None] * 3),
+        }
+    )
+    registrations = pd.DataFrame(
+        {
+            "patient_id": [1, 2, 3],
+            "practice": [1, 1, 2],
+            "region": ["London"] * 3,
+            "start_date": pd.to_datetime(["2000-01-01"] * 3),
+            "end_date": pd.to_datetime([None] * 3),
+        }
+    )
+    addresses = pd.DataFrame(
+        {
+            "patient_id": [1, 2, 3],
+            "imd": [100, 200, 300],
+            "start_date": pd.to_datetime(["2000-01-01"] * 3),
+            "end_date": pd.to_datetime([None] * 3),
+        }
+    )
+    events = pd.DataFrame(
+        events, columns=["patient_id", "code", "date", "numeric_value"]
+    ).astype({"numeric_value": float})
+    events["date"] = pd.to_datetime(events["date"])
+    return Source(
+        {
+            "patients": patients,
+            "registrations": registrations,
+            "addresses": addresses,
+            "clinical_events": events,
+        }
+    )
+
+
+def test_mean_recorded_value_ignores_missing_values():
+    # Patient 1 has a reading without a value on the day of measurement,
+    # patient 2 only readings without a value, patient 3 no readings
+    source = make_source(
+        [
+            (1, "sys", "2020-06-01", 120),
+            (1, "sys", "2020-06-01", np.nan),
+            (1, "sys", "2020-06-01", 140),
+            (1, "sys", "2020-01-01", 200),
+            (2, "sys", "2020-06-01", np.nan),
+        ]
+    )
+    engine = CohortEngine(source)
+    engine.columns = {}
+    engine.dates = {}
+    values = engine.patients_mean_recorded_value(
+        name="bp_sys_val_12m",
+        codelist=["sys"],
+        on_most_recent_day_of_measurement=True,
+        between=["2019-07-01", "2020-06-30"],
+    )
+    np.testing.assert_array_equal(values, [130.0, 0.0, 0.0])
+
+
+def test_unsupported_clinical_events_arguments_are_rejected():
+    engine = CohortEngine(make_source([(1, "hyp", "2020-06-01", np.nan)]))
+    engine.columns = {}
+    engine.dates = {}
+    with pytest.raises(ValueError, match="episode_defined_as"):
+        engine.patients_with_these_clinical_events(
+            name="hyp",
+            codelist=["hyp"],
+            returning="binary_flag",
+            episode_defined_as="series_ended_alive",
+        )
+
+
+def modified_times(paths):
+    return {path: os.stat(path).st_mtime_ns for path in paths}
+
+
+def test_incremental_extracts_only_out_of_date_cohorts(source, tmp_path, monkeypatch):
+    monkeypatch.chdir(REPO_DIR)
+    output_dir = str(tmp_path)
+    paths, _, skipped = run_extraction([DUMMY_STUDY], DUMMY_DATES, source, output_dir)
+    assert len(paths) == len(DUMMY_DATES) and skipped == 0
+    written = modified_times(paths)
+
+    # Nothing changed
+    paths, _, skipped = run_extraction(
+        [DUMMY_STUDY], DUMMY_DATES, source, output_dir, incremental=True
+    )
+    assert paths == [] and skipped == len(DUMMY_DATES)
+    assert modified_times(written) == written
+
+    # A missing cohort, and a month added to the range
+    os.remove(next(iter(written)))
+    paths, _, skipped = run_extraction(
+        [DUMMY_STUDY],
+        [*DUMMY_DATES, "2021-05-01"],
+        source,
+        output_dir,
+        incremental=True,
+    )
+    assert [os.path.basename(path) for path in paths] == [
+        "input_hyp003_2021-02-01.feather",
+        "input_hyp003_2021-05-01.feather",
+    ]
+    assert skipped == len(DUMMY_DATES) - 1
+
+
+def test_engine_version_invalidates_cohorts(source, tmp_path, monkeypatch):
+    monkeypatch.chdir(REPO_DIR)
+    output_dir = str(tmp_path)
+    run_extraction([DUMMY_STUDY], DUMMY_DATES, source, output_dir)
+    monkeypatch.setattr(
+        extract_monthly, "ENGINE_VERSION", extract_monthly.ENGINE_VERSION + 1
+    )
+    paths, _, skipped = run_extraction(
+        [DUMMY_STUDY], DUMMY_DATES, source, output_dir, incremental=True
+    )
+    assert len(paths) == len(DUMMY_DATES) and skipped == 0
+
+
+def test_pruned_cohorts_hold_the_measure_columns(source, tmp_path, monkeypatch):
+    monkeypatch.chdir(REPO_DIR)
+    (ethnicity,) = run_extraction(
+        ["study_definition_ethnicity"], [end_date], source, str(tmp_path)
+    )[0]
+    lookup = load_lookup(ethnicity)
+    index_dates = DUMMY_DATES[:2]
+    full, _, _ = run_extraction(
+        [DUMMY_STUDY], index_dates, source, str(tmp_path / "full"), lookup=lookup
+    )
+    pruned, _, _ = run_extraction(
+        [DUMMY_STUDY],
+        index_dates,
+        source,
+        str(tmp_path / "pruned"),
+        prune=True,
+        lookup=lookup,
+    )
+    measures = load_measures(DUMMY_STUDY)
+    columns = {"patient_id", *measure_columns(measures)} - {"population"}
+    for date, full_path, pruned_path in zip(index_dates, full, pruned):
+        df = pd.read_feather(pruned_path)
+        # Of the joined ethnicity columns, only those of the measures
+        assert set(df.columns) == columns
+        assert "eth6" in pd.read_feather(full_path)
+        pd.testing.assert_frame_equal(df, pd.read_feather(full_path)[df.columns])
+        pd.testing.assert_frame_equal(
+            calculate_measures(pruned_path, measures, date),
+            calculate_measures(full_path, measures, date),
+        )
+
+
+def test_cohorts_sorted_by_practice(source, tmp_path, monkeypatch):
+    monkeypatch.chdir(REPO_DIR)
+    index_dates = DUMMY_DATES[:1]
+    (path,), _, _ = run_extraction(
+        [DUMMY_STUDY], index_dates, source, str(tmp_path / "plain")
+    )
+    (sorted_path,), _, _ = run_extraction(
+        [DUMMY_STUDY], index_dates, source, str(tmp_path / "sorted"), by_practice=True
+    )
+    df = pd.read_feather(path)
+    expected = df.sort_values("practice", kind="stable", ignore_index=True)
+    pd.testing.assert_frame_equal(pd.read_feather(sorted_path), expected)
+    practices = sorted(df["practice"].unique())[:3]
+    pd.testing.assert_frame_equal(
+        read_practices(sorted_path, practices),
+        expected[expected["practice"].isin(practices)].reset_index(drop=True),
+    )
+    # Cohorts written unsorted are out of date
+    paths, _, _ = run_extraction(
+        [DUMMY_STUDY],
+        index_dates,
+        source,
+        str(tmp_path / "plain"),
+        incremental=True,
+        by_practice=True,
+    )
+    assert paths == [path]
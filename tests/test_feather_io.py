@@ -0,0 +1,105 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from feather_io import (
+    PRACTICE_INDEX_KEY,
+    cohort_columns,
+    read_feather,
+    read_practices,
+    read_table,
+    write_by_practice,
+)
+
+BATCH_ROWS = 8_000
+
+
+@pytest.fixture
+def cohort():
+    # Columns of every type in the cohorts, in more than one record batch
+    rng = np.random.default_rng(0)
+    n = 20_000
+    dates = pd.Timestamp("2020-01-01") + pd.to_timedelta(
+        rng.integers(0, 365, n), unit="D"
+    )
+    return pd.DataFrame(
+        {
+            "hyp_reg": rng.random(n) < 0.2,
+            "age": rng.integers(0, 100, n),
+            "bp_sys_val_12m": np.where(rng.random(n) < 0.3, np.nan, rng.normal(size=n)),
+            "hyp_lat_date": dates.where(rng.random(n) < 0.5),
+            "age_band": pd.Categorical(
+                rng.choice(np.array(["0-19", "20-29", None], dtype=object), n),
+                categories=["0-19", "20-29", "30-39"],
+            ),
+            "patient_id": np.arange(n),
+        }
+    )
+
+
+@pytest.mark.parametrize("compression", ["zstd", "lz4", "uncompressed"])
+def test_read_feather_matches_pandas(cohort, tmp_path, compression):
+    path = str(tmp_path / "input.feather")
+    cohort.to_feather(path, compression=compression, chunksize=BATCH_ROWS)
+    pd.testing.assert_frame_equal(read_feather(path), pd.read_feather(path))
+    pd.testing.assert_frame_equal(read_feather(path), cohort)
+
+
+def test_only_the_requested_columns_are_read(cohort, tmp_path):
+    path = str(tmp_path / "input.feather")
+    cohort.to_feather(path, chunksize=BATCH_ROWS)
+    assert cohort_columns(path) == list(cohort.columns)
+    columns = ["age_band", "patient_id", "bp_sys_val_12m"]
+    pd.testing.assert_frame_equal(read_feather(path, columns), cohort[columns])
+    assert read_table(path, columns).column_names == columns
+    with pytest.raises(ValueError, match="not_a_column"):
+        read_feather(path, ["not_a_column"])
+
+
+def by_practice(df):
+    return df.sort_values("practice", kind="stable", ignore_index=True)
+
+
+def test_batches_never_split_a_practice(cohort, tmp_path):
+    rng = np.random.default_rng(1)
+    # Mostly small practices, and one larger than a batch
+    practice = rng.integers(0, 200, len(cohort))
+    practice[: BATCH_ROWS + 100] = 7
+    cohort = cohort.assign(practice=rng.permutation(practice))
+    path = str(tmp_path / "input.feather")
+    write_by_practice(cohort, path, batch_rows=1_000)
+    pd.testing.assert_frame_equal(read_feather(path), by_practice(cohort))
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        index = json.loads(reader.schema.metadata[PRACTICE_INDEX_KEY])
+        assert len(index) == reader.num_record_batches > 1
+        last = -1
+        for i, (first, final) in enumerate(index):
+            practices = reader.get_batch(i)["practice"].to_numpy()
+            assert practices[0] == first and practices[-1] == final
+            assert first > last
+            last = final
+
+
+@pytest.mark.parametrize("indexed", [True, False])
+def test_read_practices_matches_a_filter(cohort, tmp_path, indexed):
+    cohort = cohort.assign(
+        practice=np.random.default_rng(1).integers(0, 200, len(cohort))
+    )
+    path = str(tmp_path / "input.feather")
+    if indexed:
+        write_by_practice(cohort, path, batch_rows=1_000)
+    else:
+        cohort.to_feather(path)
+    expected = by_practice(cohort) if indexed else cohort
+    practices = [3, 150, 42, 42, 1_000]
+    selected = expected[expected["practice"].isin(practices)].reset_index(drop=True)
+    pd.testing.assert_frame_equal(read_practices(path, practices), selected)
+    columns = ["age_band", "hyp_reg"]
+    pd.testing.assert_frame_equal(
+        read_practices(path, practices, columns), selected[columns]
+    )
+    assert read_practices(path, [1_000]).empty
@@ -0,0 +1,91 @@
+import importlib
+
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+import pytest
+
+from conftest import DUMMY_DATES, DUMMY_STUDY
+from disclosure import round_counts
+from generate_measures import calculate_measures, cohort_files, generate_measures
+
+
+@pytest.fixture(scope="module")
+def measures(dummy_dir):
+    return importlib.import_module(DUMMY_STUDY).measures
+
+
+def cohortextractor_measure(path, measure):
+    # Measure as `cohortextractor generate_measures` calculates it
+    df = pd.read_feather(path)
+    df["population"] = 1
+    return measure.calculate(df, lambda message: None)
+
+
+def test_measures_match_cohortextractor(dummy_dir, measures):
+    for date, path in cohort_files(dummy_dir, "_hyp003"):
+        results = calculate_measures(path, measures, date)
+        for measure in measures:
+            expected = cohortextractor_measure(path, measure)
+            actual = results[results["measure_id"] == measure.id]
+            assert len(actual) == len(expected), measure.id
+            if measure.group_by != ["population"]:
+                categories = (
+                    expected[measure.group_by].astype(str).agg(",".join, axis=1)
+                )
+                assert list(actual["category"]) == list(categories), measure.id
+            for column, name in [
+                ("numerator", measure.numerator),
+                ("denominator", measure.denominator),
+                ("value", "value"),
+            ]:
+                np.testing.assert_array_equal(
+                    actual[column].to_numpy(),
+                    expected[name].to_numpy(dtype=float),
+                    f"{measure.id} {column}",
+                )
+
+
+def test_long_file_has_every_measure_and_month(dummy_dir, measures, tmp_path):
+    path, rows = generate_measures(DUMMY_STUDY, dummy_dir, str(tmp_path))
+    df = pd.read_csv(path)
+    assert len(df) == rows
+    assert set(df["measure_id"]) == {measure.id for measure in measures}
+    assert sorted(df["date"].unique()) == DUMMY_DATES
+    population = df[df["group"] == "population"]
+    assert (population["category"] == "population").all()
+
+
+def test_dataset_holds_the_rows_of_the_long_file(dummy_dir, tmp_path):
+    dataset_dir = tmp_path / "measures_long"
+    path, _ = generate_measures(
+        DUMMY_STUDY, dummy_dir, str(tmp_path), dataset_dir=str(dataset_dir)
+    )
+    dataset = ds.dataset(str(dataset_dir), partitioning="hive")
+    df = dataset.to_table().to_pandas()
+    assert set(df["indicator"]) == {"hyp003"}
+    pd.testing.assert_frame_equal(
+        df.drop(columns="indicator").assign(date=df["date"].astype(str)),
+        pd.read_csv(path, dtype={"category": str}),
+        check_dtype=False,
+    )
+    # One row group per month
+    (fragment,) = dataset.get_fragments()
+    assert fragment.metadata.num_row_groups == len(DUMMY_DATES)
+    measure_id = "hyp003_achievem_population_rate"
+    selected = dataset.to_table(
+        filter=(ds.field("indicator") == "hyp003")
+        & (ds.field("measure_id") == measure_id)
+    )
+    assert selected.num_rows == len(DUMMY_DATES)
+
+
+def test_release_file_is_rounded(dummy_dir, tmp_path):
+    generate_measures(DUMMY_STUDY, dummy_dir, str(tmp_path), release_file=True)
+    long = pd.read_csv(tmp_path / "measures_long_hyp003.csv")
+    released = pd.read_csv(tmp_path / "measures_release_hyp003.csv")
+    assert len(released) == len(long)
+    for column in ["numerator", "denominator"]:
+        counts = released[column].dropna()
+        assert (counts % 10 == 0).all()
+        np.testing.assert_array_equal(counts, round_counts(long[column].dropna()))
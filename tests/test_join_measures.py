@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from join_measures import INDICATORS, join_measures
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures", "join_measures")
+
+# Values that readr::write_csv writes for missing and non-finite doubles
+NOT_FINITE = ["NA", "NaN", "Inf", "-Inf"]
+
+
+def read_text(path):
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+
+def test_csv_matches_join_measures_r(tmp_path):
+    # expected/measures_hyp001.csv is the output of join_measures.R for the
+    # measure files in input/
+    join_measures(
+        os.path.join(FIXTURES_DIR, "input"),
+        str(tmp_path),
+        "hyp001",
+        INDICATORS["hyp001"],
+    )
+    expected = read_text(os.path.join(FIXTURES_DIR, "expected", "measures_hyp001.csv"))
+    actual = read_text(tmp_path / "measures_hyp001.csv")
+    assert sorted(actual.columns) == sorted(expected.columns)
+    actual = actual[expected.columns]
+    other = expected.columns.drop("value")
+    pd.testing.assert_frame_equal(actual[other], expected[other])
+    finite = ~expected["value"].isin(NOT_FINITE)
+    pd.testing.assert_series_equal(actual["value"][~finite], expected["value"][~finite])
+    np.testing.assert_allclose(
+        actual["value"][finite].astype(float), expected["value"][finite].astype(float)
+    )
+
+
+def test_feather_has_logical_categories(tmp_path):
+    join_measures(
+        os.path.join(FIXTURES_DIR, "input"),
+        str(tmp_path),
+        "hyp001",
+        INDICATORS["hyp001"],
+    )
+    df = pd.read_feather(tmp_path / "measures_hyp001.feather")
+    care_home = df[df["group"] == "care_home"]
+    assert set(care_home["category"]) == {"TRUE", "FALSE"}
+    # The practice breakdown is left out, as by join_measures.R
+    assert "practice" not in set(df["group"])
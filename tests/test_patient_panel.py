@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import DUMMY_DATES, DUMMY_STUDY
+from generate_measures import cohort_files
+from patient_panel import MAX_MONTHS, flag_matrix, flags_panel, read_flags, write_panel
+
+VARIABLES = ["hyp_reg", "hyp003_denominator", "age_band"]
+
+
+def monthly_cohorts(dummy_dir):
+    return {
+        date: pd.read_feather(path) for date, path in cohort_files(dummy_dir, "_hyp003")
+    }
+
+
+def test_long_panel(dummy_dir, tmp_path):
+    path, rows = write_panel(dummy_dir, str(tmp_path), DUMMY_STUDY, "long", VARIABLES)
+    frames = [
+        df[["patient_id", *VARIABLES]].assign(index_date=pd.Timestamp(date))
+        for date, df in monthly_cohorts(dummy_dir).items()
+    ]
+    expected = (
+        pd.concat(frames)
+        .sort_values(["patient_id", "index_date"])
+        .reset_index(drop=True)[["patient_id", "index_date", *VARIABLES]]
+    )
+    panel = pd.read_feather(path)
+    assert rows == len(expected)
+    pd.testing.assert_frame_equal(panel, expected)
+
+
+def test_flags_panel(dummy_dir, tmp_path):
+    path, _ = write_panel(dummy_dir, str(tmp_path), DUMMY_STUDY, "flags")
+    panel, months = read_flags(path)
+    assert months == DUMMY_DATES
+    cohorts = monthly_cohorts(dummy_dir)
+    patient_ids = np.unique(
+        np.concatenate([df["patient_id"] for df in cohorts.values()])
+    )
+    np.testing.assert_array_equal(panel["patient_id"], patient_ids)
+    flags = [
+        column for column in panel.columns if column not in ("patient_id", "in_cohort")
+    ]
+    assert {"hyp_reg", "hyp003_denominator", "hyp003_numerator"} <= set(flags)
+    in_cohort = flag_matrix(panel["in_cohort"], months)
+    for month, df in enumerate(cohorts.values()):
+        np.testing.assert_array_equal(
+            in_cohort[:, month], np.isin(patient_ids, df["patient_id"])
+        )
+        df = df.set_index("patient_id").reindex(patient_ids)
+        for flag in flags:
+            np.testing.assert_array_equal(
+                flag_matrix(panel[flag], months)[:, month],
+                df[flag].fillna(False).to_numpy(dtype=bool),
+                f"{flag} in {months[month]}",
+            )
+
+
+def test_flags_panel_is_limited_to_64_months():
+    cohorts = [(f"month {i}", "input.feather") for i in range(MAX_MONTHS + 1)]
+    with pytest.raises(ValueError, match="split the index date range"):
+        flags_panel(cohorts, ["hyp_reg"])
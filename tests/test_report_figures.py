@@ -0,0 +1,92 @@
+import json
+import os
+import shutil
+
+import pandas as pd
+
+from deciles import calculate_deciles
+from join_measures import INDICATORS, join_measures
+from report_figures import render_report
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures", "join_measures")
+
+
+def make_inputs(tmp_path):
+    # Joined measures and deciles of HYP001, as written by join_measures.py and
+    # deciles.py
+    input_dir = os.path.join(FIXTURES_DIR, "input")
+    measures_dir = tmp_path / "measures"
+    measures_dir.mkdir()
+    join_measures(input_dir, str(measures_dir), "hyp001", INDICATORS["hyp001"])
+    deciles_file = tmp_path / "deciles.csv"
+    calculate_deciles(input_dir, ["hyp001"]).to_csv(deciles_file, index=False)
+    return str(measures_dir), str(deciles_file)
+
+
+def render(tmp_path, measures_dir, deciles_file):
+    return render_report(
+        measures_dir,
+        deciles_file,
+        str(tmp_path / "report"),
+        str(tmp_path / "report" / "cache"),
+        workers=1,
+    )
+
+
+def figures(tmp_path):
+    return sorted(
+        file for file in os.listdir(tmp_path / "report") if file.endswith(".png")
+    )
+
+
+def manifest(tmp_path):
+    with open(tmp_path / "report" / "report_figures_manifest.json") as f:
+        return json.load(f)
+
+
+def test_renders_a_figure_per_indicator_and_breakdown(tmp_path):
+    measures_dir, deciles_file = make_inputs(tmp_path)
+    assert render(tmp_path, measures_dir, deciles_file) == (4, 4)
+    assert figures(tmp_path) == [
+        "deciles_hyp001.png",
+        "measures_hyp001_care_home.png",
+        "measures_hyp001_population.png",
+        "measures_hyp001_sex.png",
+    ]
+    assert sorted(manifest(tmp_path)) == figures(tmp_path)
+    # Nothing changed
+    assert render(tmp_path, measures_dir, deciles_file) == (0, 4)
+
+
+def test_only_figures_whose_data_changed_are_rendered(tmp_path):
+    measures_dir, deciles_file = make_inputs(tmp_path)
+    render(tmp_path, measures_dir, deciles_file)
+    before = manifest(tmp_path)
+    path = os.path.join(measures_dir, "measures_hyp001.csv")
+    df = pd.read_csv(path, dtype=str, keep_default_na=False)
+    df.loc[df["group"] == "sex", "value"] = "0.5"
+    df.to_csv(path, index=False)
+    assert render(tmp_path, measures_dir, deciles_file) == (1, 4)
+    after = manifest(tmp_path)
+    assert [name for name in after if after[name] != before[name]] == [
+        "measures_hyp001_sex.png"
+    ]
+
+
+def test_figures_no_longer_in_the_inputs_are_removed(tmp_path):
+    measures_dir, deciles_file = make_inputs(tmp_path)
+    render(tmp_path, measures_dir, deciles_file)
+    # The deciles are left out, and an indicator is dropped
+    shutil.copy(
+        os.path.join(measures_dir, "measures_hyp001.csv"),
+        os.path.join(measures_dir, "measures_hyp003.csv"),
+    )
+    render(tmp_path, measures_dir, None)
+    os.remove(os.path.join(measures_dir, "measures_hyp001.csv"))
+    assert render(tmp_path, measures_dir, None) == (0, 3)
+    assert figures(tmp_path) == [
+        "measures_hyp003_care_home.png",
+        "measures_hyp003_population.png",
+        "measures_hyp003_sex.png",
+    ]
+    assert sorted(manifest(tmp_path)) == figures(tmp_path)
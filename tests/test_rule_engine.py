@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from extract_monthly import MonthlyExtractor, load_source, output_path
+from feather_io import read_feather
+from rule_engine import recompute_rules
+from synthetic_population import generate_population
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUDY_NAME = "study_definition_hyp003"
+INDEX_DATE = "2021-03-01"
+
+
+@pytest.fixture(scope="module")
+def extracted(tmp_path_factory):
+    # A cohort extracted from a small synthetic population, and its study
+    tmp_path = tmp_path_factory.mktemp("extract")
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        # Codelists are read relative to the repository
+        monkeypatch.chdir(REPO_DIR)
+        generate_population(2_000, str(tmp_path / "source"))
+        source = load_source(str(tmp_path / "source"))
+        extractor = MonthlyExtractor([STUDY_NAME], source, str(tmp_path))
+        extractor.extract(INDEX_DATE, [STUDY_NAME])
+    path = output_path(str(tmp_path), STUDY_NAME, INDEX_DATE)
+    return extractor.studies[STUDY_NAME], read_feather(path)
+
+
+def test_recompute_reproduces_extracted_rules(extracted):
+    study, cohort = extracted
+    recomputed, _, names = recompute_rules(study, cohort.copy())
+    assert "bp_sys_dia_max_cutoff" in names
+    for name in names:
+        np.testing.assert_array_equal(
+            recomputed[name].to_numpy(object), cohort[name].to_numpy(object), name
+        )
+
+
+def test_recompute_keeps_other_columns(extracted):
+    study, cohort = extracted
+    cohort = cohort.assign(
+        ethnicity6=pd.Categorical(
+            np.where(cohort["patient_id"] % 2 == 0, "White", None),
+            categories=["White", "Other"],
+        )
+    )
+    recomputed, _, _ = recompute_rules(study, cohort.copy())
+    pd.testing.assert_series_equal(recomputed["ethnicity6"], cohort["ethnicity6"])
+
+
+def test_recompute_compares_missing_values_as_false(extracted):
+    study, cohort = extracted
+    cohort = cohort.copy()
+    cohort["bp_sys_val_12m"] = np.nan
+    recomputed, _, _ = recompute_rules(study, cohort)
+    assert not recomputed["bp_sys_dia_max_cutoff"].any()
+
+
+def test_recompute_keeps_the_categories_of_extracted_cohorts(extracted):
+    # Including in a cohort where only some of the categories occur
+    study, cohort = extracted
+    few = cohort[cohort["age_band"] == "50-59"].reset_index(drop=True)
+    for df in [cohort, few]:
+        recomputed, _, names = recompute_rules(study, df.copy())
+        assert "age_band" in names
+        for name in names:
+            assert recomputed[name].dtype == cohort[name].dtype, name
+        pd.testing.assert_frame_equal(recomputed, df)